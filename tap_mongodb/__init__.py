@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import concurrent.futures
 import copy
+import hashlib
 import json
+import os
 import ssl
 import sys
 import time
+import uuid
 import pymongo
 from bson.codec_options import DatetimeConversion
 
@@ -11,6 +15,7 @@ import singer
 from singer import metadata, metrics, utils
 
 import tap_mongodb.sync_strategies.common as common
+import tap_mongodb.sync_strategies.change_streams as change_streams
 import tap_mongodb.sync_strategies.full_table as full_table
 import tap_mongodb.sync_strategies.oplog as oplog
 import tap_mongodb.sync_strategies.incremental as incremental
@@ -118,11 +123,13 @@ def get_databases(client, config):
     return db_names
 
 
-def produce_collection_schema(collection):
+def produce_collection_schema(collection, options=None, coll_indexes=None):
     collection_name = collection.name
     collection_db_name = collection.database.name
 
-    is_view = collection.options().get('viewOn') is not None
+    if options is None:
+        options = collection.options()
+    is_view = options.get('viewOn') is not None
 
     mdata = {}
     mdata = metadata.write(mdata, (), 'table-key-properties', ['_id'])
@@ -134,15 +141,24 @@ def produce_collection_schema(collection):
     # cannot get indexes for views -- NB: This means no key-based incremental for views?
     if not is_view:
         valid_replication_keys = []
-        coll_indexes = collection.index_information()
+        compound_replication_keys = []
+        if coll_indexes is None:
+            coll_indexes = collection.index_information()
         # index_information() returns a map of index_name -> index_information
         for _, index_info in coll_indexes.items():
-            # we don't support compound indexes
             if len(index_info.get('key')) == 1:
                 index_field_info = index_info.get('key')[0]
                 # index_field_info is a tuple of (field_name, sort_direction)
                 if index_field_info:
                     valid_replication_keys.append(index_field_info[0])
+            elif incremental.is_usable_index(index_info):
+                # a compound index can be scanned in order of its first field, or in
+                # order of its second field by merging one scan per first field value
+                compound_replication_keys.extend(field for field, _ in index_info['key'][:2])
+
+        for field in compound_replication_keys:
+            if field not in valid_replication_keys:
+                valid_replication_keys.append(field)
 
         if valid_replication_keys:
             mdata = metadata.write(mdata, (), 'valid-replication-keys', valid_replication_keys)
@@ -158,26 +174,158 @@ def produce_collection_schema(collection):
     }
 
 
-def do_discover(client, config):
-    streams = []
+def list_collections(client, db_name):
+    '''
+    Return the listCollections information of the collections of db_name by
+    name, from a single command, leaving out system collections and views.
+    '''
+    collection_infos = {}
+    for collection_info in client[db_name].list_collections():
+        # TODO: Add support for views
+        if collection_info['name'].startswith('system.') or \
+           collection_info.get('options', {}).get('viewOn') is not None:
+            continue
+        collection_infos[collection_info['name']] = collection_info
+    return collection_infos
+
+
+def list_catalog_indexes(client, db_names):
+    '''
+    Return the indexes of the collections of db_names by database and collection
+    name, in the format of index_information(), from a single $listCatalog
+    aggregation. Returns None before MongoDB 6.0 or when the user may not run
+    it, the indexes are then read collection by collection.
+    '''
+    if tuple(client.server_info().get('versionArray', [])[:2]) < (6, 0):
+        return None
 
-    for db_name in get_databases(client, config):
-        # pylint: disable=invalid-name
-        db = client[db_name]
+    pipeline = [{'$listCatalog': {}},
+                {'$match': {'db': {'$in': db_names}}},
+                {'$project': {'db': 1, 'name': 1, 'md.indexes.spec': 1}}]
+    try:
+        catalog = list(client.admin.aggregate(pipeline))
+    except pymongo.errors.OperationFailure as ex:
+        LOGGER.info('Reading indexes collection by collection, $listCatalog failed: %s', ex)
+        return None
 
-        collection_names = db.list_collection_names()
-        for collection_name in [c for c in collection_names
-                                if not c.startswith("system.")]:
+    catalog_indexes = {}
+    for entry in catalog:
+        coll_indexes = {}
+        for index in entry.get('md', {}).get('indexes', []):
+            index_info = dict(index['spec'])
+            index_info['key'] = list(index_info['key'].items())
+            coll_indexes[index_info.pop('name')] = index_info
+        catalog_indexes.setdefault(entry['db'], {})[entry['name']] = coll_indexes
+    return catalog_indexes
 
-            collection = db[collection_name]
-            is_view = collection.options().get('viewOn') is not None
-            # TODO: Add support for views
-            if is_view:
-                continue
 
-            LOGGER.info("Getting collection info for db: %s, collection: %s",
-                        db_name, collection_name)
-            streams.append(produce_collection_schema(collection))
+def get_collection_uuid(collection_info):
+    collection_uuid = collection_info.get('info', {}).get('uuid')
+    if collection_uuid is None:
+        return None
+    if isinstance(collection_uuid, uuid.UUID):
+        return collection_uuid.hex
+    return bytes(collection_uuid).hex()
+
+
+def get_collection_fingerprint(db_name, collection_name, options, coll_indexes):
+    # a renamed collection keeps its UUID
+    return hashlib.sha256(json.dumps([db_name, collection_name, options, coll_indexes],
+                                     sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_discovery_cache(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as cache_file:
+        return json.load(cache_file)
+
+
+def write_discovery_cache(path, discovery_cache):
+    # replace the cache at once, a discovery that fails midway leaves the
+    # previous one in place
+    with open(path + '.tmp', 'w', encoding='utf-8') as cache_file:
+        json.dump(discovery_cache, cache_file)
+    os.replace(path + '.tmp', path)
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def discover_collection(client, db_name, collection_name, collection_info, coll_indexes, discovery_cache):
+    '''
+    Return the stream of a collection and its discovery cache entry, if it has
+    a UUID. The stream in discovery_cache is reused as is when the collection
+    has the same UUID, name, options and indexes, without querying the
+    collection. Its row-count is then the one of the discovery that cached it.
+    coll_indexes is None when the indexes are not listed in bulk, before
+    MongoDB 6.0, and a cached stream then keeps the indexes it was discovered
+    with.
+    '''
+    collection = client[db_name][collection_name]
+    options = collection_info.get('options', {})
+    collection_uuid = get_collection_uuid(collection_info)
+
+    if discovery_cache is None or collection_uuid is None:
+        LOGGER.info("Getting collection info for db: %s, collection: %s",
+                    db_name, collection_name)
+        return produce_collection_schema(collection, options, coll_indexes), None
+
+    fingerprint = get_collection_fingerprint(db_name, collection_name, options, coll_indexes)
+    cache_entry = discovery_cache.get(collection_uuid)
+    if cache_entry is None or cache_entry['fingerprint'] != fingerprint:
+        LOGGER.info("Getting collection info for db: %s, collection: %s",
+                    db_name, collection_name)
+        cache_entry = {'fingerprint': fingerprint,
+                       'stream': produce_collection_schema(collection, options, coll_indexes)}
+
+    return cache_entry['stream'], (collection_uuid, cache_entry)
+
+
+def do_discover(client, config):
+    '''
+    Discover the collections of every database on a pool of DISCOVERY_WORKERS
+    threads. Streams are written ordered by database and collection name.
+    On MongoDB 6.0+ the indexes of every collection are listed at once with
+    $listCatalog. With discovery_cache, collections that kept their UUID, name,
+    options and indexes since the last discovery reuse their stream from the
+    cache, and only new or altered collections are queried.
+    '''
+    cache_path = config.get('discovery_cache')
+    discovery_cache = load_discovery_cache(cache_path) if cache_path else None
+
+    phase_start_time = time.time()
+    db_names = sorted(get_databases(client, config))
+    LOGGER.info('Listed %s databases in %.2f seconds', len(db_names), time.time() - phase_start_time)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=common.DISCOVERY_WORKERS) as executor:
+        phase_start_time = time.time()
+        collection_infos = executor.map(lambda db_name: list_collections(client, db_name), db_names)
+        collections = [(db_name, collection_name, collection_info)
+                       for db_name, infos_by_name in zip(db_names, collection_infos)
+                       for collection_name, collection_info in sorted(infos_by_name.items())]
+        LOGGER.info('Listed %s collections in %.2f seconds', len(collections), time.time() - phase_start_time)
+
+        phase_start_time = time.time()
+        catalog_indexes = list_catalog_indexes(client, db_names)
+        if catalog_indexes is not None:
+            LOGGER.info('Listed the indexes of %s databases in %.2f seconds',
+                        len(catalog_indexes), time.time() - phase_start_time)
+
+        def discover(collection):
+            db_name, collection_name, _ = collection
+            coll_indexes = None
+            if catalog_indexes is not None:
+                coll_indexes = catalog_indexes.get(db_name, {}).get(collection_name)
+            return discover_collection(client, *collection, coll_indexes, discovery_cache)
+
+        phase_start_time = time.time()
+        results = list(executor.map(discover, collections))
+        LOGGER.info('Discovered %s collections in %.2f seconds',
+                    len(results), time.time() - phase_start_time)
+
+    streams = [stream for stream, _ in results]
+    if cache_path:
+        # collections that were dropped leave the cache
+        write_discovery_cache(cache_path, dict(cache_entry for _, cache_entry in results if cache_entry))
 
     json.dump({'streams' : streams}, sys.stdout, indent=2)
 
@@ -190,14 +338,23 @@ def is_stream_selected(stream):
     return is_selected == True
 
 
-def get_streams_to_sync(streams, state):
+def get_streams_to_sync(streams, state, age_out_forecast=None):
 
     # get selected streams
     selected_streams = [s for s in streams if is_stream_selected(s)]
+
+    # streams whose oplog bookmark is about to age out go first, soonest first,
+    # so they are not forced into a full resync
+    age_out_forecast = age_out_forecast or {}
+    at_risk_streams = sorted([s for s in selected_streams if is_at_risk(s, age_out_forecast)],
+                             key=lambda s: age_out_forecast[s['tap_stream_id']])
+
     # prioritize streams that have not been processed
     streams_with_state = []
     streams_without_state = []
     for stream in selected_streams:
+        if stream in at_risk_streams:
+            continue
         if state.get('bookmarks', {}).get(stream['tap_stream_id']):
             streams_with_state.append(stream)
         else:
@@ -221,7 +378,36 @@ def get_streams_to_sync(streams, state):
     else:
         streams_to_sync = ordered_streams
 
-    return streams_to_sync
+    return at_risk_streams + streams_to_sync
+
+
+def is_at_risk(stream, age_out_forecast):
+    seconds = age_out_forecast.get(stream['tap_stream_id'])
+    return seconds is not None and seconds < common.OPLOG_AGE_OUT_WARNING_SECONDS
+
+
+def get_age_out_forecast(client, streams, state):
+    '''
+    Project, from the growth rate of the oplog, how many seconds are left before
+    the bookmark of each selected LOG_BASED stream ages out of it, and warn about
+    the streams that have less than OPLOG_AGE_OUT_WARNING_SECONDS left.
+    '''
+    tap_stream_ids = [stream['tap_stream_id'] for stream in streams
+                      if is_stream_selected(stream) and is_oplog_stream(stream)
+                      and oplog.get_bookmarked_ts(state, stream['tap_stream_id']) is not None]
+    if not tap_stream_ids:
+        return {}
+
+    forecast = oplog.forecast_aged_out(client, state, tap_stream_ids)
+    for tap_stream_id, seconds in forecast.items():
+        tags = {'tap_stream_id': tap_stream_id}
+        metrics.log(LOGGER, metrics.Point('gauge', 'oplog_age_out_seconds', seconds, tags))
+        if seconds < common.OPLOG_AGE_OUT_WARNING_SECONDS:
+            LOGGER.warning('The oplog bookmark of %s is projected to age out in %.0f seconds, syncing it first',
+                           tap_stream_id, seconds)
+            metrics.log(LOGGER, metrics.Point('counter', 'oplog_age_out_warning', 1, tags))
+
+    return forecast
 
 
 def write_schema_message(stream):
@@ -279,6 +465,49 @@ def clear_state_on_replication_change(stream, state):
 
     return state
 
+def sync_log_based_stream(client, stream, state, stream_projection):
+    tap_stream_id = stream['tap_stream_id']
+
+    if common.LOG_BASED_ENGINE == 'change_streams':
+        has_aged_out = change_streams.has_aged_out(client, stream, state)
+    else:
+        has_aged_out = oplog.oplog_has_aged_out(client, state, tap_stream_id)
+
+    if has_aged_out:
+        # remove all state for stream
+        # then it will do a full sync and start oplog again.
+        LOGGER.info("Clearing state because Oplog has aged out")
+        state.get('bookmarks', {}).pop(tap_stream_id)
+
+    if common.LOG_BASED_ENGINE == 'change_streams':
+        collection_oplog_ts = change_streams.get_latest_ts(client)
+    else:
+        collection_oplog_ts = oplog.get_cluster_latest_ts(client)
+
+    # make sure initial full table sync has been completed
+    if not singer.get_bookmark(state, tap_stream_id, 'initial_full_table_complete'):
+        msg = 'Must complete full table sync before starting oplog replication for %s'
+        LOGGER.info(msg, tap_stream_id)
+
+        # only mark current ts in oplog on first sync so tap has a
+        # starting point after the full table sync
+        if singer.get_bookmark(state, tap_stream_id, 'version') is None:
+            oplog.update_bookmarks(state, tap_stream_id, collection_oplog_ts)
+
+        # read the collection as of the bookmarked oplog timestamp so the
+        # oplog sync does not replay changes the full table sync already saw
+        snapshot_ts = None
+        if common.SNAPSHOT_INITIAL_SYNC:
+            snapshot_ts = oplog.get_bookmarked_ts(state, tap_stream_id)
+
+        full_table.sync_collection(client, stream, state, stream_projection, snapshot_ts)
+
+    # the oplog engine syncs all LOG_BASED streams together once they are ready,
+    # see sync_oplog_streams
+    if common.LOG_BASED_ENGINE == 'change_streams':
+        change_streams.sync_collection(client, stream, state, stream_projection, collection_oplog_ts)
+
+
 def sync_stream(client, stream, state):
     tap_stream_id = stream['tap_stream_id']
 
@@ -307,27 +536,7 @@ def sync_stream(client, stream, state):
         timer.tags['table'] = stream['table_name']
 
         if replication_method == 'LOG_BASED':
-            if oplog.oplog_has_aged_out(client, state, tap_stream_id):
-                # remove all state for stream
-                # then it will do a full sync and start oplog again.
-                LOGGER.info("Clearing state because Oplog has aged out")
-                state.get('bookmarks', {}).pop(tap_stream_id)
-
-            collection_oplog_ts = oplog.get_latest_ts(client)
-
-            # make sure initial full table sync has been completed
-            if not singer.get_bookmark(state, tap_stream_id, 'initial_full_table_complete'):
-                msg = 'Must complete full table sync before starting oplog replication for %s'
-                LOGGER.info(msg, tap_stream_id)
-
-                # only mark current ts in oplog on first sync so tap has a
-                # starting point after the full table sync
-                if singer.get_bookmark(state, tap_stream_id, 'version') is None:
-                    oplog.update_bookmarks(state, tap_stream_id, collection_oplog_ts)
-
-                full_table.sync_collection(client, stream, state, stream_projection)
-
-            oplog.sync_collection(client, stream, state, stream_projection, collection_oplog_ts)
+            sync_log_based_stream(client, stream, state, stream_projection)
 
         elif replication_method == 'FULL_TABLE':
             full_table.sync_collection(client, stream, state, stream_projection)
@@ -344,16 +553,170 @@ def sync_stream(client, stream, state):
     singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
 
 
+def is_oplog_stream(stream):
+    md_map = metadata.to_map(stream['metadata'])
+    return metadata.get(md_map, (), 'replication-method') == 'LOG_BASED' and \
+        common.LOG_BASED_ENGINE == 'oplog'
+
+
+def sync_oplog_streams(client, streams, state):
+    '''
+    Sync the LOG_BASED streams in a single pass over the oplog, instead of
+    reading the same oplog window once per stream. With tail_oplog, the pass
+    keeps following the oplog until the tap is stopped.
+    '''
+    max_oplog_ts = oplog.get_cluster_latest_ts(client)
+    stream_projections = {stream['tap_stream_id']: load_stream_projection(stream) for stream in streams}
+
+    LOGGER.info('Starting oplog sync for %s', ', '.join(stream['tap_stream_id'] for stream in streams))
+    with metrics.job_timer('sync_oplog') as timer:
+        timer.tags['streams'] = len(streams)
+        oplog.sync_collections(client, streams, state, stream_projections, max_oplog_ts, common.TAIL_OPLOG)
+
+    singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+
+def get_change_fingerprint(client, stream, state):
+    md_map = metadata.to_map(stream['metadata'])
+    tap_stream_id = stream['tap_stream_id']
+    replication_method = metadata.get(md_map, (), 'replication-method')
+    replication_key = metadata.get(md_map, (), 'replication-key')
+    collection = client[metadata.get(md_map, (), 'database-name')][stream['stream']]
+
+    # never skip a stream that has to resume an interrupted sync
+    if singer.get_currently_syncing(state) == tap_stream_id:
+        return None
+
+    if replication_method == 'FULL_TABLE':
+        if full_table.is_interrupted(state, tap_stream_id):
+            return None
+        fingerprint = full_table.get_change_fingerprint(collection, common.CHANGE_PROBE)
+    elif replication_method == 'INCREMENTAL':
+        fingerprint = incremental.get_change_fingerprint(collection, replication_key)
+    else:
+        # LOG_BASED streams only read the oplog entries past their bookmark already
+        return None
+
+    if fingerprint is None:
+        return None
+    return '{}:{}:{}'.format(replication_method, replication_key, fingerprint)
+
+
+def has_pending_window(client, stream, state):
+    '''
+    Whether the bookmark of an INCREMENTAL stream is before the max replication
+    key value. A run bounded by tap-mongodb.incremental-window stopped short of
+    it, and the next run has to go on even though the collection has not changed.
+    '''
+    md_map = metadata.to_map(stream['metadata'])
+    stream_state = state.get('bookmarks', {}).get(stream['tap_stream_id'], {})
+    if metadata.get(md_map, (), 'replication-method') != 'INCREMENTAL' or \
+       stream_state.get('replication_key_value') is None:
+        return False
+
+    replication_key = metadata.get(md_map, (), 'replication-key')
+    collection = client[metadata.get(md_map, (), 'database-name')][stream['stream']]
+    lower = common.string_to_class(stream_state['replication_key_value'], stream_state.get('replication_key_type'))
+    max_value = incremental.get_max_replication_key_value(collection,
+                                                          replication_key,
+                                                          incremental.get_index_plan(collection, replication_key))
+    return incremental.is_after(max_value, lower)
+
+
+def get_shard_clients(client, connection_params):
+    '''
+    Connect to the replica set of every shard of the cluster that client is
+    connected to through mongos, to read their oplogs.
+    '''
+    shard_clients = {}
+    for shard in client.config.shards.find(sort=[('_id', pymongo.ASCENDING)]):
+        # the host of a shard is '<replica set>/<host:port>,<host:port>,...'
+        if '/' not in shard['host']:
+            raise Exception("Shard {} is not a replica set and has no oplog".format(shard['_id']))
+        replica_set, hosts = shard['host'].split('/', 1)
+
+        shard_params = {k: v for k, v in connection_params.items() if k != 'port'}
+        shard_params.update({'host': hosts.split(','),
+                             'replicaset': replica_set,
+                             'directConnection': False})
+        shard_clients[shard['_id']] = pymongo.MongoClient(**shard_params)
+
+    LOGGER.info('Reading the oplogs of shards %s', ', '.join(shard_clients))
+    return shard_clients
+
+
 def do_sync(client, catalog, state):
     all_streams = catalog['streams']
-    streams_to_sync = get_streams_to_sync(all_streams, state)
+    age_out_forecast = get_age_out_forecast(client, all_streams, state)
+    streams_to_sync = get_streams_to_sync(all_streams, state, age_out_forecast)
+    oplog_streams = []
+
+    # the oplog of the streams about to age out is synced before the other
+    # streams, unless it is tailed, which only ends with the tap
+    at_risk_count = len([s for s in streams_to_sync if is_at_risk(s, age_out_forecast)])
+
+    for index, stream in enumerate(streams_to_sync):
+        tap_stream_id = stream['tap_stream_id']
+
+        fingerprint = None
+        if common.CHANGE_PROBE:
+            fingerprint = get_change_fingerprint(client, stream, state)
+            if fingerprint is not None and \
+               fingerprint == singer.get_bookmark(state, tap_stream_id, 'change_fingerprint') and \
+               not has_pending_window(client, stream, state):
+                LOGGER.info('Skipping %s, it has not changed since the last sync', tap_stream_id)
+                continue
 
-    for stream in streams_to_sync:
         sync_stream(client, stream, state)
 
+        if is_oplog_stream(stream):
+            oplog_streams.append(stream)
+
+        if fingerprint is not None:
+            state = singer.write_bookmark(state, tap_stream_id, 'change_fingerprint', fingerprint)
+            singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+        if index + 1 == at_risk_count and not common.TAIL_OPLOG:
+            sync_oplog_streams(client, oplog_streams, state)
+            oplog_streams = []
+
+    if oplog_streams:
+        sync_oplog_streams(client, oplog_streams, state)
+
     common.get_sync_summary(catalog)
 
 
+def get_change_probe(config):
+    change_probe = config.get('change_probe')
+    if change_probe and change_probe not in ('collstats', 'dbhash'):
+        raise Exception("change_probe must be either collstats or dbhash (you passed {})".format(change_probe))
+    return change_probe
+
+
+def set_log_based_config(config):
+    '''
+    Set the options of LOG_BASED replication from config, and return whether
+    the oplogs of the shards of a sharded cluster are read.
+    '''
+    common.APPLY_UPDATE_DELTAS = config.get('apply_update_deltas') == 'true'
+    common.OPLOG_AGGREGATION = config.get('oplog_aggregation') == 'true'
+    common.LOG_BASED_ENGINE = config.get('log_based_engine', 'oplog')
+    if common.LOG_BASED_ENGINE not in ('oplog', 'change_streams'):
+        raise Exception("log_based_engine must be either oplog or change_streams (you passed {})"
+                        .format(common.LOG_BASED_ENGINE))
+    common.TAIL_OPLOG = config.get('tail_oplog') == 'true'
+    if common.TAIL_OPLOG and common.LOG_BASED_ENGINE != 'oplog':
+        raise Exception("tail_oplog requires the oplog log_based_engine")
+    if common.TAIL_OPLOG and common.OPLOG_AGGREGATION:
+        # the tailable cursor is a find, aggregate cannot tail the oplog
+        raise Exception("tail_oplog cannot be used with oplog_aggregation")
+
+    sharded_cluster = config.get('sharded_cluster') == 'true'
+    if sharded_cluster and (common.LOG_BASED_ENGINE != 'oplog' or common.TAIL_OPLOG):
+        raise Exception("sharded_cluster requires the oplog log_based_engine, without tail_oplog")
+    return sharded_cluster
+
+
 def main_impl():
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
     config = args.config
@@ -386,6 +749,30 @@ def main_impl():
     common.INCLUDE_SCHEMAS_IN_DESTINATION_STREAM_NAME = \
         (config.get('include_schemas_in_destination_stream_name') == 'true')
 
+    if config.get('max_parallel_cursors'):
+        common.MAX_PARALLEL_CURSORS = int(config['max_parallel_cursors'])
+    if config.get('discovery_workers'):
+        common.DISCOVERY_WORKERS = int(config['discovery_workers'])
+
+    common.CHANGE_PROBE = get_change_probe(config)
+    common.SNAPSHOT_INITIAL_SYNC = config.get('snapshot_initial_sync') == 'true'
+    common.RAW_BSON_DECODE = config.get('raw_bson_decode') == 'true'
+    if config.get('checkpoint_seconds'):
+        common.CHECKPOINT_SECONDS = float(config['checkpoint_seconds'])
+    if config.get('checkpoint_bytes'):
+        common.CHECKPOINT_BYTES = int(config['checkpoint_bytes'])
+    if config.get('lag_report_seconds'):
+        common.LAG_REPORT_SECONDS = float(config['lag_report_seconds'])
+    if config.get('oplog_age_out_warning_seconds'):
+        common.OPLOG_AGE_OUT_WARNING_SECONDS = float(config['oplog_age_out_warning_seconds'])
+    if set_log_based_config(config) and not args.discover:
+        common.SHARD_CLIENTS = get_shard_clients(client, connection_params)
+    common.ADAPTIVE_BATCH_SIZE = config.get('adaptive_batch_size') == 'true'
+    if config.get('target_batch_bytes'):
+        common.TARGET_BATCH_BYTES = int(config['target_batch_bytes'])
+    if config.get('target_batch_seconds'):
+        common.TARGET_BATCH_SECONDS = float(config['target_batch_seconds'])
+
     if args.discover:
         do_discover(client, config)
     elif args.catalog:
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import copy
+import time
+import pymongo
+import singer
+from singer import metadata, utils
+
+import tap_mongodb.sync_strategies.common as common
+import tap_mongodb.sync_strategies.oplog as oplog
+
+LOGGER = singer.get_logger()
+
+# ChangeStreamHistoryLost and ChangeStreamFatalError, raised when the resume
+# point is no longer in the oplog
+HISTORY_LOST_ERROR_CODES = {280, 286}
+
+# server side wait for new changes before a getMore returns an empty batch
+MAX_AWAIT_TIME_MS = 1000
+
+CHANGE_OPERATION_TYPES = ['insert', 'update', 'replace', 'delete']
+
+
+def get_latest_ts(client):
+    # the optime of the last write, without read access to local.oplog.rs
+    return client.admin.command('hello')['lastWrite']['opTime']['ts']
+
+
+def get_resume_token(state, tap_stream_id):
+    return singer.get_bookmark(state, tap_stream_id, 'resume_token')
+
+
+def update_bookmarks(state, tap_stream_id, resume_token, cluster_time=None):
+    state = singer.write_bookmark(state, tap_stream_id, 'resume_token', resume_token)
+    # keep the oplog timestamp bookmark too, the stream starts from it when there
+    # is no resume token and the oplog engine can pick up from it
+    if cluster_time is not None:
+        state = oplog.update_bookmarks(state, tap_stream_id, cluster_time)
+    return state
+
+
+def transform_projection(projection):
+    '''
+    Turn the stream projection into a $project stage over change events. The
+    fields of the change event the sync reads are always kept.
+    '''
+    if projection is None:
+        return None
+
+    temp_projection = {k: v for k, v in projection.items() if k != '_id'}
+    # int(bool(v)) will return 1 if v is any of non empty string, True or number > 0
+    is_whitelist = not temp_projection or sum([int(bool(v)) for v in temp_projection.values()]) > 0
+
+    if not is_whitelist:
+        return {'fullDocument.' + field: value for field, value in temp_projection.items()}
+
+    new_projection = {'_id': 1, 'operationType': 1, 'clusterTime': 1, 'documentKey': 1,
+                      'fullDocument._id': 1}
+    for field, value in temp_projection.items():
+        new_projection['fullDocument.' + field] = value
+    return new_projection
+
+
+def build_pipeline(projection):
+    pipeline = [{'$match': {'operationType': {'$in': CHANGE_OPERATION_TYPES}}}]
+    change_projection = transform_projection(projection)
+    if change_projection:
+        pipeline.append({'$project': change_projection})
+    return pipeline
+
+
+def get_full_document_option(collection):
+    # post-images are stored with the change on MongoDB 6.0+ when the collection
+    # enables them, otherwise the current document is looked up for every update
+    options = collection.options()
+    if options.get('changeStreamPreAndPostImages', {}).get('enabled'):
+        return 'required'
+    return 'updateLookup'
+
+
+def watch(collection, state, tap_stream_id, pipeline=None, full_document=None):
+    resume_token = get_resume_token(state, tap_stream_id)
+    if resume_token is not None:
+        return collection.watch(pipeline,
+                                full_document=full_document,
+                                resume_after=resume_token,
+                                max_await_time_ms=MAX_AWAIT_TIME_MS)
+
+    return collection.watch(pipeline,
+                            full_document=full_document,
+                            start_at_operation_time=oplog.get_bookmarked_ts(state, tap_stream_id),
+                            max_await_time_ms=MAX_AWAIT_TIME_MS)
+
+
+def has_aged_out(client, stream, state):
+    tap_stream_id = stream['tap_stream_id']
+    if get_resume_token(state, tap_stream_id) is None and \
+       oplog.get_bookmarked_ts(state, tap_stream_id) is None:
+        return False
+
+    md_map = metadata.to_map(stream['metadata'])
+    collection = client[metadata.get(md_map, (), 'database-name')][stream['stream']]
+    try:
+        # the server checks that the resume point is still available when the
+        # stream is opened
+        with watch(collection, state, tap_stream_id):
+            return False
+    except pymongo.errors.OperationFailure as ex:
+        if ex.code in HISTORY_LOST_ERROR_CODES:
+            return True
+        raise
+
+
+def get_change_row(change):
+    '''
+    Return the document to emit for a change event, or None if there is none,
+    e.g. for an update of a document deleted before it could be looked up.
+    '''
+    if change['operationType'] == 'delete':
+        # delete events only contain the _id of the document deleted
+        return {'_id': change['documentKey']['_id'],
+                oplog.SDC_DELETED_AT: change['clusterTime']}
+
+    return change.get('fullDocument')
+
+
+# pylint: disable=too-many-locals
+def sync_collection(client, stream, state, stream_projection, max_oplog_ts=None):
+    tap_stream_id = stream['tap_stream_id']
+    LOGGER.info('Starting change stream sync for %s', tap_stream_id)
+
+    md_map = metadata.to_map(stream['metadata'])
+    collection = client[metadata.get(md_map, (), 'database-name')][stream['stream']]
+
+    # Write activate version message
+    version = common.get_stream_version(tap_stream_id, state)
+    activate_version_message = singer.ActivateVersionMessage(
+        stream=common.calculate_destination_stream_name(stream),
+        version=version
+    )
+    singer.write_message(activate_version_message)
+
+    time_extracted = utils.now()
+    rows_saved = 0
+    checkpoints = common.CheckpointScheduler()
+    lag = common.LagReporter(tap_stream_id)
+    start_time = time.time()
+
+    pipeline = build_pipeline(stream_projection)
+    full_document = get_full_document_option(collection)
+
+    LOGGER.info('Watching %s with:\n\tPipeline: %s\n\tFull Document: %s\n\tResume Token: %s',
+                tap_stream_id, pipeline, full_document, get_resume_token(state, tap_stream_id))
+
+    schema = {"type": "object", "properties": {}}
+    caught_up = False
+    with watch(collection, state, tap_stream_id, pipeline, full_document) as change_stream:
+        while change_stream.alive:
+            change = change_stream.try_next()
+            if change is None:
+                caught_up = True
+                break
+
+            lag.observe_oplog_entry()
+            row = get_change_row(change)
+            if row is not None:
+                common.write_row(stream, schema, row, version, time_extracted)
+                checkpoints.observe_record(row)
+                lag.observe_records()
+                rows_saved += 1
+
+            state = update_bookmarks(state, tap_stream_id, change['_id'], change['clusterTime'])
+
+            if checkpoints.checkpoint():
+                singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+            if lag.is_due():
+                lag.report(change['clusterTime'], get_latest_ts(client))
+
+            # stop at the changes made after the sync started, like the oplog
+            # engine, so a busy collection does not keep the stream open
+            if max_oplog_ts is not None and change['clusterTime'] > max_oplog_ts:
+                break
+
+        # the token of the last batch advances past changes filtered out by the
+        # server, so the next sync does not read them again
+        if change_stream.resume_token is not None:
+            state = update_bookmarks(state, tap_stream_id, change_stream.resume_token)
+
+    if caught_up and max_oplog_ts is not None:
+        bookmarked_ts = oplog.get_bookmarked_ts(state, tap_stream_id)
+        state = oplog.update_bookmarks(state,
+                                       tap_stream_id,
+                                       max(bookmarked_ts, max_oplog_ts) if bookmarked_ts else max_oplog_ts)
+    singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+    synced_ts = oplog.get_bookmarked_ts(state, tap_stream_id)
+    if synced_ts is not None:
+        lag.report(synced_ts, get_latest_ts(client))
+
+    common.COUNTS[tap_stream_id] += rows_saved
+    common.TIMES[tap_stream_id] += time.time()-start_time
+    LOGGER.info('Synced %s records for %s', rows_saved, tap_stream_id)
@@ -1,26 +1,66 @@
 #!/usr/bin/env python3
 import base64
+import concurrent.futures
 import datetime
+import queue
+import threading
 import time
 import uuid
 import decimal
+import json
 import bson
 import singer
-from singer import utils, metadata
+from pymongo.errors import ConfigurationError, OperationFailure
+from singer import utils, metadata, metrics
 from bson import objectid, timestamp, encode, decode, datetime as bson_datetime
 from bson.binary import Binary, UuidRepresentation
 from bson.codec_options import CodecOptions, DatetimeConversion
 from bson.datetime_ms import DatetimeMS
+from bson.raw_bson import RawBSONDocument
 
 import pytz
 import tzlocal
 
 INCLUDE_SCHEMAS_IN_DESTINATION_STREAM_NAME = False
 UPDATE_BOOKMARK_PERIOD = 1000
+CHECKPOINT_SECONDS = 60
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+CHECKPOINT_OPLOG_ENTRIES = 10000
+MAX_PARALLEL_CURSORS = 4
+DISCOVERY_WORKERS = 8
+PARALLEL_QUEUE_SIZE = 1000
+SAMPLES_PER_BOUNDARY = 20
+# matching samples needed per boundary, below which boundaries are read from the index
+MIN_SAMPLES_PER_BOUNDARY = 4
+CURSOR_EXHAUSTED = object()
+ADAPTIVE_BATCH_SIZE = False
+TARGET_BATCH_BYTES = 8 * 1024 * 1024
+TARGET_BATCH_SECONDS = 1.0
+MIN_BATCH_SIZE = 2
+MAX_BATCH_SIZE = 100000
+DOCUMENT_SIZE_SAMPLE_PERIOD = 64
+RAW_BSON_DECODE = False
+SNAPSHOT_INITIAL_SYNC = False
+# SnapshotTooOld, SnapshotUnavailable
+SNAPSHOT_ERROR_CODES = {239, 246}
+SESSION_REFRESH_PERIOD = 600
+CHANGE_PROBE = None
+LOG_BASED_ENGINE = 'oplog'
+APPLY_UPDATE_DELTAS = False
+OPLOG_AGGREGATION = False
+TAIL_OPLOG = False
+# shard id to client of its replica set, when reading the oplogs of a sharded cluster
+SHARD_CLIENTS = {}
+LAG_REPORT_SECONDS = 60
+OPLOG_AGE_OUT_WARNING_SECONDS = 3600
 COUNTS = {}
 TIMES = {}
 SCHEMA_COUNT = {}
 SCHEMA_TIMES = {}
+BATCH_SIZES = {}
+BATCH_SIZES_LOCK = threading.Lock()
+UPDATE_BUFFER_FLUSHES = {}
+OPLOG_LAG = {}
 
 LOGGER = singer.get_logger()
 
@@ -36,6 +76,9 @@ class MongoAssertionException(Exception):
 class MongoInvalidDateTimeException(Exception):
     """Raised if we find an invalid date-time that we can't handle"""
 
+class OplogRolledOverException(Exception):
+    """Raised if the oplog dropped entries that were not read yet"""
+
 def calculate_destination_stream_name(stream):
     s_md = metadata.to_map(stream['metadata'])
     if INCLUDE_SCHEMAS_IN_DESTINATION_STREAM_NAME:
@@ -43,6 +86,80 @@ def calculate_destination_stream_name(stream):
 
     return stream['stream']
 
+def with_raw_bson_decoding(collection):
+    '''
+    When RAW_BSON_DECODE is enabled, return collection with a codec that yields
+    RawBSONDocuments. A batch is then kept as undecoded bytes and each document and
+    nested subdocument is only decoded when the transform and schema steps reach it.
+    '''
+    if not RAW_BSON_DECODE:
+        return collection
+
+    return collection.with_options(
+        codec_options=collection.codec_options.with_options(document_class=RawBSONDocument))
+
+class SessionNotAvailable():
+    def __enter__(self, *args):
+        pass
+    def __exit__(self, *args):
+        pass
+
+def maybe_get_session(client):
+    '''
+    Try to get a session. If sessions are not available to us then return an object
+    that will work in the context manager
+    '''
+    try:
+        return client.start_session()
+    except ConfigurationError:
+        # log sessions not available
+        LOGGER.info('Unable to start session, without session')
+        # return an object that works with a 'with' block
+        return SessionNotAvailable()
+
+def find_command(collection, session=None, **command_args):
+    '''
+    Run a find command on collection with command_args and return its cursor. This
+    reaches find options that Collection.find does not expose.
+    '''
+    database = collection.database.with_options(codec_options=collection.codec_options,
+                                                read_preference=collection.read_preference)
+    return database.cursor_command('find',
+                                   collection.name,
+                                   read_preference=collection.read_preference,
+                                   codec_options=collection.codec_options,
+                                   session=session,
+                                   **command_args)
+
+def snapshot_read_concern(snapshot_ts):
+    return {'level': 'snapshot', 'atClusterTime': snapshot_ts}
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def get_snapshot_history_seconds(client):
+    '''
+    Return the server's minSnapshotHistoryWindowInSeconds, how long it keeps the
+    history that reads at a past cluster time need, or None if it cannot be read.
+    '''
+    try:
+        result = client.admin.command('getParameter', 1, minSnapshotHistoryWindowInSeconds=1)
+    except OperationFailure:
+        return None
+    return result.get('minSnapshotHistoryWindowInSeconds')
+
+
+def find_at_snapshot(collection, find_filter, projection, sort, snapshot_ts, session=None):
+    '''
+    Run a find with readConcern snapshot pinned to snapshot_ts, so the documents
+    read reflect exactly the writes up to that cluster time.
+    '''
+    command_args = {'filter': find_filter,
+                    'sort': dict(sort),
+                    'readConcern': snapshot_read_concern(snapshot_ts)}
+    if projection:
+        command_args['projection'] = projection
+
+    return find_command(collection, session=session, **command_args)
+
 def whitelist_bookmark_keys(bookmark_key_set, tap_stream_id, state):
     for bookmark_key in [non_whitelisted_bookmark_key
                          for non_whitelisted_bookmark_key
@@ -132,7 +249,7 @@ def transform_value(value, path):
     if isinstance(value, list):
         # pylint: disable=unnecessary-lambda
         return list(map(lambda v: transform_value(v[1], path + [v[0]]), enumerate(value)))
-    if isinstance(value, dict):
+    if isinstance(value, (dict, RawBSONDocument)):
         return {k:transform_value(v, path + [k]) for k, v in value.items()}
     if isinstance(value, uuid.UUID):
         return str(value)
@@ -196,6 +313,23 @@ def row_to_singer_record(stream, row, version, time_extracted):
         version=version,
         time_extracted=time_extracted)
 
+def write_row(stream, schema, row, stream_version, time_extracted):
+    schema_build_start_time = time.time()
+    if row_to_schema(schema, row):
+        singer.write_message(singer.SchemaMessage(
+            stream=calculate_destination_stream_name(stream),
+            schema=schema,
+            key_properties=['_id']))
+        SCHEMA_COUNT[stream['tap_stream_id']] += 1
+    SCHEMA_TIMES[stream['tap_stream_id']] += time.time() - schema_build_start_time
+
+    record_message = row_to_singer_record(stream,
+                                          row,
+                                          stream_version,
+                                          time_extracted)
+
+    singer.write_message(record_message, allow_nan=True)
+
 def add_to_any_of(schema, value):
     changed = False
 
@@ -250,7 +384,7 @@ def add_to_any_of(schema, value):
 
             changed = True
 
-    elif isinstance(value, dict):
+    elif isinstance(value, (dict, RawBSONDocument)):
         has_object = False
 
         # get pointer to object schema and see if it already existed
@@ -301,6 +435,7 @@ def row_to_schema(schema, row):
                               bson.decimal128.Decimal128,
                               float,
                               dict,
+                              RawBSONDocument,
                               list)):
 
             # get pointer to field's anyOf list
@@ -313,6 +448,331 @@ def row_to_schema(schema, row):
 
     return changed
 
+class BatchSizer():
+    '''
+    Picks the batch size of the next getMore from the observed document size and
+    getMore latency, so that a batch stays close to both TARGET_BATCH_BYTES and
+    TARGET_BATCH_SECONDS. The batch size at most doubles between two getMores.
+    '''
+    def __init__(self):
+        self.batch_size = None
+        self.document_size = None
+        self.seconds_per_document = None
+
+    def observe_document_size(self, size):
+        if self.document_size is None:
+            self.document_size = size
+        else:
+            self.document_size = 0.8 * self.document_size + 0.2 * size
+
+    def observe_batch(self, documents, seconds):
+        if documents <= 0:
+            return
+        seconds_per_document = seconds / documents
+        if self.seconds_per_document is None:
+            self.seconds_per_document = seconds_per_document
+        else:
+            self.seconds_per_document = 0.8 * self.seconds_per_document + 0.2 * seconds_per_document
+
+        if self.batch_size is None:
+            self.batch_size = documents
+
+    def next_batch_size(self):
+        batch_size = MAX_BATCH_SIZE
+        if self.document_size:
+            batch_size = min(batch_size, TARGET_BATCH_BYTES / self.document_size)
+        if self.seconds_per_document:
+            batch_size = min(batch_size, TARGET_BATCH_SECONDS / self.seconds_per_document)
+        if self.batch_size:
+            batch_size = min(batch_size, self.batch_size * 2)
+
+        self.batch_size = int(max(MIN_BATCH_SIZE, min(batch_size, MAX_BATCH_SIZE)))
+        return self.batch_size
+
+
+class CheckpointScheduler():
+    '''
+    Decides when a sync writes a state message: once UPDATE_BOOKMARK_PERIOD
+    records, CHECKPOINT_BYTES of records (estimated from a sample of them) or
+    CHECKPOINT_OPLOG_ENTRIES oplog entries have gone by since the last one, or
+    CHECKPOINT_SECONDS have elapsed. Sparse streams then still checkpoint
+    regularly, and busy ones do not write more state than needed.
+    '''
+    def __init__(self):
+        self.records = 0
+        self.bytes = 0
+        self.oplog_entries = 0
+        self.checkpoint_time = time.time()
+
+    def observe_record(self, row=None):
+        self.records += 1
+        if row is not None and self.records % DOCUMENT_SIZE_SAMPLE_PERIOD == 1:
+            self.bytes += get_document_size(row) * DOCUMENT_SIZE_SAMPLE_PERIOD
+
+    def observe_oplog_entry(self):
+        self.oplog_entries += 1
+
+    def is_due(self):
+        return self.records >= UPDATE_BOOKMARK_PERIOD \
+            or self.bytes >= CHECKPOINT_BYTES \
+            or self.oplog_entries >= CHECKPOINT_OPLOG_ENTRIES \
+            or time.time() - self.checkpoint_time >= CHECKPOINT_SECONDS
+
+    def checkpoint(self):
+        '''
+        Return whether a checkpoint is due, starting the next period if it is.
+        '''
+        if not self.is_due():
+            return False
+        self.records = 0
+        self.bytes = 0
+        self.oplog_entries = 0
+        self.checkpoint_time = time.time()
+        return True
+
+
+class LagReporter():
+    '''
+    Reports, every LAG_REPORT_SECONDS, how far a LOG_BASED stream is behind the
+    head of the oplog as singer metrics: the lag in seconds, the oplog entries
+    read and records written per second, the update buffer lookups issued and
+    the time to catch up at the rate the lag went down since the last report.
+    The last report of each stream is kept in OPLOG_LAG for the sync summary.
+    '''
+    def __init__(self, tap_stream_id):
+        self.tap_stream_id = tap_stream_id
+        self.tags = {'tap_stream_id': tap_stream_id}
+        self.report_time = time.time()
+        self.lag_seconds = None
+        self.oplog_entries = 0
+        self.records = 0
+        self.lookups = 0
+
+    def observe_oplog_entry(self):
+        self.oplog_entries += 1
+
+    def observe_records(self, count=1):
+        self.records += count
+
+    def observe_lookup(self):
+        self.lookups += 1
+
+    def is_due(self):
+        return time.time() - self.report_time >= LAG_REPORT_SECONDS
+
+    def report(self, oplog_ts, head_ts):
+        '''
+        Report the stream at oplog_ts, with head_ts the ts of the last write.
+        '''
+        now = time.time()
+        seconds = max(now - self.report_time, 0.000001)
+        lag_seconds = max(head_ts.time - oplog_ts.time, 0)
+
+        if lag_seconds == 0:
+            catch_up_seconds = 0
+        elif self.lag_seconds is not None and self.lag_seconds > lag_seconds:
+            catch_up_seconds = lag_seconds * seconds / (self.lag_seconds - lag_seconds)
+        else:
+            # the lag is not going down
+            catch_up_seconds = None
+
+        report = {'lag_seconds': lag_seconds,
+                  'oplog_entries_per_second': self.oplog_entries / seconds,
+                  'records_per_second': self.records / seconds,
+                  'update_buffer_lookups': self.lookups,
+                  'catch_up_seconds': catch_up_seconds}
+
+        metrics.log(LOGGER, metrics.Point('gauge', 'oplog_lag_seconds', lag_seconds, self.tags))
+        metrics.log(LOGGER, metrics.Point('gauge', 'oplog_entries_per_second',
+                                          report['oplog_entries_per_second'], self.tags))
+        metrics.log(LOGGER, metrics.Point('gauge', 'records_per_second', report['records_per_second'], self.tags))
+        metrics.log(LOGGER, metrics.Point('counter', 'update_buffer_lookups', self.lookups, self.tags))
+        metrics.log(LOGGER, metrics.Point('gauge', 'oplog_catch_up_seconds', catch_up_seconds, self.tags))
+
+        OPLOG_LAG[self.tap_stream_id] = report
+        self.report_time = now
+        self.lag_seconds = lag_seconds
+        self.oplog_entries = 0
+        self.records = 0
+        self.lookups = 0
+        return report
+
+
+def get_document_size(row):
+    raw = getattr(row, 'raw', None)
+    if raw is not None:
+        return len(raw)
+    return len(encode(row))
+
+
+def record_batch_size(tap_stream_id, batch_size):
+    with BATCH_SIZES_LOCK:
+        sizes = BATCH_SIZES.setdefault(tap_stream_id, {'count': 0, 'total': 0, 'min': None, 'max': None})
+        sizes['count'] += 1
+        sizes['total'] += batch_size
+        sizes['min'] = batch_size if sizes['min'] is None else min(sizes['min'], batch_size)
+        sizes['max'] = batch_size if sizes['max'] is None else max(sizes['max'], batch_size)
+
+
+def record_update_buffer_flush(tap_stream_id, length, max_length):
+    flushes = UPDATE_BUFFER_FLUSHES.setdefault(tap_stream_id, {'count': 0, 'ids': 0, 'fill': 0, 'seconds': 0})
+    flushes['count'] += 1
+    flushes['ids'] += length
+    flushes['fill'] += min(length / max_length, 1)
+
+
+def record_update_buffer_lookup(tap_stream_id, seconds):
+    UPDATE_BUFFER_FLUSHES[tap_stream_id]['seconds'] += seconds
+
+
+def iterate_cursor(cursor, tap_stream_id):
+    '''
+    Iterate cursor, resizing every getMore with a BatchSizer when
+    ADAPTIVE_BATCH_SIZE is enabled. Command cursors do not report how many
+    documents they retrieved and are iterated as is.
+    '''
+    if not ADAPTIVE_BATCH_SIZE or not hasattr(cursor, 'retrieved'):
+        for row in cursor:
+            yield row
+        return
+
+    sizer = BatchSizer()
+    retrieved = 0
+    rows_seen = 0
+    while True:
+        fetch_start_time = time.time()
+        try:
+            row = next(cursor)
+        except StopIteration:
+            return
+
+        if cursor.retrieved != retrieved:
+            # this call had to wait for a new batch from the server
+            sizer.observe_batch(cursor.retrieved - retrieved, time.time() - fetch_start_time)
+            retrieved = cursor.retrieved
+            sizer.observe_document_size(get_document_size(row))
+            batch_size = sizer.next_batch_size()
+            # Cursor.batch_size() refuses to change a cursor that has been iterated,
+            # but the value is read again before every getMore.
+            cursor._batch_size = batch_size # pylint: disable=protected-access
+            record_batch_size(tap_stream_id, batch_size)
+        elif rows_seen % DOCUMENT_SIZE_SAMPLE_PERIOD == 0:
+            sizer.observe_document_size(get_document_size(row))
+
+        rows_seen += 1
+        yield row
+
+
+def sample_boundaries(collection, field, find_filter, count, value_type):
+    '''
+    Sample the documents matching find_filter and return up to count - 1 ascending,
+    distinct values of field which split them into count ranges of roughly equal size.
+    Only values of value_type are used since range queries are type bracketed.
+
+    $sample comes first so the server picks documents with its random cursor
+    instead of reading and shuffling every matching document. When too few of
+    the samples match find_filter, e.g. for a narrow range of a large collection,
+    the boundaries are read from the index on field instead.
+    '''
+    pipeline = [{'$sample': {'size': count * SAMPLES_PER_BOUNDARY}},
+                {'$match': find_filter},
+                {'$project': {field: 1}},
+                {'$sort': {field: 1}}]
+
+    values = [row.get(field) for row in collection.aggregate(pipeline)]
+    values = [v for v in values if v.__class__.__name__ == value_type]
+    if len(values) < count * MIN_SAMPLES_PER_BOUNDARY:
+        return get_index_boundaries(collection, field, find_filter, count, value_type)
+
+    boundaries = []
+    for i in range(1, count):
+        boundary = values[len(values) * i // count]
+        if not boundaries or boundaries[-1] != boundary:
+            boundaries.append(boundary)
+    return boundaries
+
+
+def get_index_boundaries(collection, field, find_filter, count, value_type):
+    '''
+    Return the values of field at every count-th of the documents matching
+    find_filter, by skipping through the index on field. Only index keys are
+    scanned, no document is fetched.
+    '''
+    total = collection.count_documents(find_filter)
+    projection = {field: 1} if field == '_id' else {field: 1, '_id': 0}
+
+    boundaries = []
+    for i in range(1, count):
+        position = total * i // count
+        if position == 0:
+            continue
+        rows = list(collection.find(find_filter, projection).sort(field, 1).skip(position).limit(1))
+        if not rows or rows[0].get(field).__class__.__name__ != value_type:
+            continue
+        boundary = rows[0][field]
+        if not boundaries or boundaries[-1] != boundary:
+            boundaries.append(boundary)
+    return boundaries
+
+
+def put_until_stopped(rows, item, stop):
+    '''
+    Put item on the bounded queue rows, waiting for room until stop is set.
+    Returns False if the reader stopped before item was put.
+    '''
+    while not stop.is_set():
+        try:
+            rows.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def drain_cursor(rows, stop, index, cursor_factory, tap_stream_id=None):
+    '''
+    Worker of the parallel cursor readers: put the (index, row) tuples of the
+    cursor returned by cursor_factory on rows, then (index, CURSOR_EXHAUSTED),
+    or (index, exception) if reading fails.
+    '''
+    try:
+        with cursor_factory() as cursor:
+            for row in iterate_cursor(cursor, tap_stream_id):
+                if not put_until_stopped(rows, (index, row), stop):
+                    return
+        put_until_stopped(rows, (index, CURSOR_EXHAUSTED), stop)
+    except Exception as ex: # pylint: disable=broad-except
+        put_until_stopped(rows, (index, ex), stop)
+
+
+def read_cursors_in_parallel(cursor_factories, max_workers=None, tap_stream_id=None):
+    '''
+    Open and drain the cursors returned by cursor_factories on a worker pool and
+    yield (index, row) tuples in the order rows arrive. Rows from one cursor keep
+    their order. Once a cursor is drained (index, CURSOR_EXHAUSTED) is yielded.
+    Messages and state are still written by the caller, on the main thread.
+    '''
+    rows = queue.Queue(maxsize=PARALLEL_QUEUE_SIZE)
+    stop = threading.Event()
+
+    remaining = len(cursor_factories)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or MAX_PARALLEL_CURSORS) as executor:
+        for index, cursor_factory in enumerate(cursor_factories):
+            executor.submit(drain_cursor, rows, stop, index, cursor_factory, tap_stream_id)
+        try:
+            while remaining:
+                index, row = rows.get()
+                if isinstance(row, Exception):
+                    raise row
+                if row is CURSOR_EXHAUSTED:
+                    remaining -= 1
+                yield index, row
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
 def get_sync_summary(catalog):
     headers = [['database',
                 'collection',
@@ -322,9 +782,13 @@ def get_sync_summary(catalog):
                 'total time',
                 'schemas written',
                 'schema build duration',
-                'percent building schemas']]
+                'percent building schemas',
+                'batch sizes',
+                'update buffer flushes',
+                'oplog lag']]
 
     rows = []
+    summaries = []
     for stream_id, stream_count in COUNTS.items():
         stream = [x for x in catalog['streams'] if x['tap_stream_id'] == stream_id][0]
         collection_name = stream.get("table_name")
@@ -337,6 +801,28 @@ def get_sync_summary(catalog):
         schema_duration = SCHEMA_TIMES[stream_id]
         if stream_time == 0:
             stream_time = 0.000001
+        batch_sizes = BATCH_SIZES.get(stream_id)
+        if batch_sizes:
+            batch_sizes_summary = '{}-{} (avg {:.0f}) documents'.format(batch_sizes['min'],
+                                                                       batch_sizes['max'],
+                                                                       batch_sizes['total'] / batch_sizes['count'])
+        else:
+            batch_sizes_summary = 'default'
+        flushes = UPDATE_BUFFER_FLUSHES.get(stream_id)
+        if flushes:
+            flushes_summary = '{} flushes of avg {:.0f} ids ({:.0f}% full) in avg {:.5f} seconds'.format(
+                flushes['count'],
+                flushes['ids'] / flushes['count'],
+                100 * flushes['fill'] / flushes['count'],
+                flushes['seconds'] / flushes['count'])
+        else:
+            flushes_summary = 'none'
+        lag = OPLOG_LAG.get(stream_id)
+        if lag:
+            lag_summary = '{} seconds behind, {:.1f} entries/second'.format(lag['lag_seconds'],
+                                                                          lag['oplog_entries_per_second'])
+        else:
+            lag_summary = 'none'
         row = [
             db_name,
             collection_name,
@@ -346,10 +832,20 @@ def get_sync_summary(catalog):
             '{:.5f} seconds'.format(stream_time),
             '{} schemas'.format(schemas_written),
             '{:.5f} seconds'.format(schema_duration),
-            '{:.2f}%'.format(100*schema_duration/stream_time)
+            '{:.2f}%'.format(100*schema_duration/stream_time),
+            batch_sizes_summary,
+            flushes_summary,
+            lag_summary
         ]
         rows.append(row)
+        summaries.append({'tap_stream_id': stream_id,
+                          'replication_method': replication_method,
+                          'records': stream_count,
+                          'seconds': TIMES[stream_id],
+                          'update_buffer_flushes': flushes,
+                          'oplog_lag': lag})
     LOGGER.info("\n**** Sync Summary:")
     LOGGER.info(next(iter(headers), None))
     for row in rows:
         LOGGER.info(row)
+    LOGGER.info('SYNC SUMMARY: %s', json.dumps(summaries))
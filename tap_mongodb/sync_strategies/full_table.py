@@ -8,6 +8,9 @@ import tap_mongodb.sync_strategies.common as common
 
 LOGGER = singer.get_logger()
 
+# returned when a natural order scan cannot resume after its record id
+KEY_NOT_FOUND = 211
+
 def get_max_id_value(collection, projection=None):
     if projection is None:
         row = collection.find_one(sort=[("_id", pymongo.DESCENDING)])
@@ -21,8 +24,308 @@ def get_max_id_value(collection, projection=None):
     return None
 
 
+def is_interrupted(state, tap_stream_id):
+    # last run was interrupted if there is a last_id_fetched, last_record_id or partitions bookmark
+    return (singer.get_bookmark(state, tap_stream_id, 'last_id_fetched') is not None
+            or singer.get_bookmark(state, tap_stream_id, 'last_record_id') is not None
+            or singer.get_bookmark(state, tap_stream_id, 'partitions') is not None)
+
+
+def get_change_fingerprint(collection, probe):
+    '''
+    Return a value that changes when the collection changes. dbhash, the default,
+    hashes every document on the server. collstats only looks at the document
+    count, data size and max _id, and misses updates that keep the document size.
+    '''
+    if probe != 'collstats':
+        result = collection.database.command('dbHash', collections=[collection.name])
+        return result.get('collections', {}).get(collection.name)
+
+    storage_stats = next(collection.aggregate([{'$collStats': {'storageStats': {}}}]), {}).get('storageStats', {})
+    max_id_value = get_max_id_value(collection, projection={'_id': 1})
+    return '{}:{}:{}'.format(storage_stats.get('count'),
+                             storage_stats.get('size'),
+                             repr(max_id_value))
+
+
+def get_scan_order(stream):
+    md_map = metadata.to_map(stream['metadata'])
+    scan_order = metadata.get(md_map, (), 'tap-mongodb.full-table-scan') or '_id'
+    if scan_order not in ('_id', 'natural'):
+        raise Exception("tap-mongodb.full-table-scan must be one of _id or natural (you passed {})"
+                        .format(scan_order))
+    return scan_order
+
+
+def get_partition_count(stream):
+    md_map = metadata.to_map(stream['metadata'])
+    partition_count = metadata.get(md_map, (), 'tap-mongodb.full-table-partitions')
+    if not partition_count:
+        return 1
+    return max(int(partition_count), 1)
+
+
+def build_partitions(collection, max_id_value, partition_count):
+    id_type = max_id_value.__class__.__name__
+    boundaries = common.sample_boundaries(collection,
+                                          '_id',
+                                          {'_id': {'$lte': max_id_value}},
+                                          partition_count,
+                                          id_type)
+    boundaries = [b for b in boundaries if b != max_id_value]
+
+    # each partition covers [min, max), the last one ends at max_id_value inclusively
+    lower_bounds = [None] + boundaries
+    upper_bounds = boundaries + [max_id_value]
+    return [{'min': None if lower is None else common.class_to_string(lower, id_type),
+             'max': common.class_to_string(upper, id_type),
+             'max_inclusive': index == len(upper_bounds) - 1,
+             'type': id_type,
+             'last_id_fetched': None,
+             'complete': False}
+            for index, (lower, upper) in enumerate(zip(lower_bounds, upper_bounds))]
+
+
+def get_partition_filter(partition):
+    id_type = partition['type']
+    if partition['max_inclusive']:
+        find_filter = {'$lte': common.string_to_class(partition['max'], id_type)}
+    else:
+        find_filter = {'$lt': common.string_to_class(partition['max'], id_type)}
+
+    if partition['last_id_fetched'] is not None:
+        find_filter['$gte'] = common.string_to_class(partition['last_id_fetched'], id_type)
+    elif partition['min'] is not None:
+        find_filter['$gte'] = common.string_to_class(partition['min'], id_type)
+    return find_filter
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def find_id_range(collection, id_filter, projection, snapshot_ts=None, session=None):
+    if snapshot_ts is None:
+        return collection.find({'_id': id_filter},
+                               projection,
+                               sort=[("_id", pymongo.ASCENDING)],
+                               session=session)
+
+    return common.find_at_snapshot(collection,
+                                   {'_id': id_filter},
+                                   projection,
+                                   [("_id", pymongo.ASCENDING)],
+                                   snapshot_ts,
+                                   session=session)
+
+
+def is_snapshot_error(ex, snapshot_ts, tap_stream_id):
+    if snapshot_ts is None or ex.code not in common.SNAPSHOT_ERROR_CODES:
+        return False
+
+    LOGGER.warning('Unable to read %s at snapshot %s (%s), continuing without a snapshot. '
+                   'Changes made during the rest of the sync will be replayed from the oplog, '
+                   'and documents they changed may be emitted twice.',
+                   tap_stream_id, snapshot_ts, ex)
+    return True
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals
+def sync_partitions(collection, stream, state, projection, partitions, stream_version, snapshot_ts=None):
+    tap_stream_id = stream['tap_stream_id']
+
+    def cursor_factory(partition):
+        return lambda: find_id_range(collection, get_partition_filter(partition), projection, snapshot_ts)
+
+    rows_saved = 0
+    checkpoints = common.CheckpointScheduler()
+    time_extracted = utils.now()
+    schema = {"type": "object", "properties": {}}
+    while True:
+        pending = [p for p in partitions if not p['complete']]
+        for partition in pending:
+            # pylint: disable=logging-format-interpolation
+            LOGGER.info('Querying {} partition with:\n\tFind Parameters: {}'.format(
+                tap_stream_id,
+                get_partition_filter(partition)))
+
+        try:
+            for index, row in common.read_cursors_in_parallel([cursor_factory(p) for p in pending],
+                                                              tap_stream_id=tap_stream_id):
+                partition = pending[index]
+
+                if row is common.CURSOR_EXHAUSTED:
+                    partition['complete'] = True
+                    state = singer.write_bookmark(state, tap_stream_id, 'partitions', partitions)
+                    singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+                    continue
+
+                rows_saved += 1
+                common.write_row(stream, schema, row, stream_version, time_extracted)
+                checkpoints.observe_record(row)
+
+                partition['last_id_fetched'] = common.class_to_string(row['_id'], partition['type'])
+                state = singer.write_bookmark(state, tap_stream_id, 'partitions', partitions)
+
+                if checkpoints.checkpoint():
+                    singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+        except pymongo.errors.OperationFailure as ex:
+            if not is_snapshot_error(ex, snapshot_ts, tap_stream_id):
+                raise
+            snapshot_ts = None
+            continue
+
+        return rows_saved
+
+
+def get_id_range_filter(state, tap_stream_id, max_id_value):
+    find_filter = {'$lte': max_id_value}
+    last_id_fetched = singer.get_bookmark(state, tap_stream_id, 'last_id_fetched')
+    if last_id_fetched:
+        last_id_fetched_type = singer.get_bookmark(state,
+                                                   tap_stream_id,
+                                                   'last_id_fetched_type')
+        find_filter['$gte'] = common.string_to_class(last_id_fetched, last_id_fetched_type)
+    return find_filter
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals
+def sync_id_range(collection, stream, state, projection, max_id_value, stream_version, snapshot_ts=None):
+    rows_saved = 0
+    checkpoints = common.CheckpointScheduler()
+    time_extracted = utils.now()
+    schema = {"type": "object", "properties": {}}
+    while True:
+        find_filter = get_id_range_filter(state, stream['tap_stream_id'], max_id_value)
+
+        query_message = 'Querying {} with:\n\tFind Parameters: {}'.format(
+            stream['tap_stream_id'],
+            find_filter)
+        if projection:
+            query_message += '\n\tProjection: {}'.format(projection)
+        if snapshot_ts:
+            query_message += '\n\tSnapshot: {}'.format(snapshot_ts)
+        # pylint: disable=logging-format-interpolation
+        LOGGER.info(query_message)
+
+        try:
+            # only snapshot reads need an explicit session
+            if snapshot_ts is None:
+                session_context = common.SessionNotAvailable()
+            else:
+                session_context = common.maybe_get_session(collection.database.client)
+
+            with session_context as session, \
+                 find_id_range(collection, find_filter, projection, snapshot_ts, session) as cursor:
+                session_refresh_time = time.time()
+
+                for row in common.iterate_cursor(cursor, stream['tap_stream_id']):
+                    rows_saved += 1
+
+                    common.write_row(stream, schema, row, stream_version, time_extracted)
+                    checkpoints.observe_record(row)
+
+                    state = singer.write_bookmark(state,
+                                                  stream['tap_stream_id'],
+                                                  'last_id_fetched',
+                                                  common.class_to_string(row['_id'],
+                                                                         row['_id'].__class__.__name__))
+                    state = singer.write_bookmark(state,
+                                                  stream['tap_stream_id'],
+                                                  'last_id_fetched_type',
+                                                  row['_id'].__class__.__name__)
+
+
+                    if checkpoints.checkpoint():
+                        singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+                    # keep a long running snapshot read's session alive. This does
+                    # not extend the snapshot history the server keeps, see
+                    # common.get_snapshot_history_seconds
+                    if session is not None and time.time() - session_refresh_time > common.SESSION_REFRESH_PERIOD:
+                        collection.database.client.admin.command('ping', session=session)
+                        session_refresh_time = time.time()
+        except pymongo.errors.OperationFailure as ex:
+            if not is_snapshot_error(ex, snapshot_ts, stream['tap_stream_id']):
+                raise
+            snapshot_ts = None
+            continue
+
+        return rows_saved
+
+
+def find_natural_order(collection, projection, last_record_id, snapshot_ts=None):
+    command_args = {'filter': {},
+                    'hint': {'$natural': 1},
+                    'showRecordId': True,
+                    '$_requestResumeToken': True}
+    if projection:
+        command_args['projection'] = projection
+    if last_record_id is not None:
+        command_args['$_resumeAfter'] = {'$recordId': last_record_id}
+    if snapshot_ts is not None:
+        command_args['readConcern'] = common.snapshot_read_concern(snapshot_ts)
+
+    return common.find_command(collection, **command_args)
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def sync_natural_order(collection, stream, state, projection, stream_version, snapshot_ts=None):
+    tap_stream_id = stream['tap_stream_id']
+
+    rows_saved = 0
+    checkpoints = common.CheckpointScheduler()
+    time_extracted = utils.now()
+    schema = {"type": "object", "properties": {}}
+    while True:
+        last_record_id = singer.get_bookmark(state, tap_stream_id, 'last_record_id')
+        if last_record_id is not None:
+            last_record_id = common.string_to_class(last_record_id,
+                                                    singer.get_bookmark(state,
+                                                                        tap_stream_id,
+                                                                        'last_record_id_type'))
+
+        LOGGER.info('Querying %s in natural order after record id %s', tap_stream_id, last_record_id)
+
+        try:
+            with find_natural_order(collection, projection, last_record_id, snapshot_ts) as cursor:
+                for row in common.iterate_cursor(cursor, tap_stream_id):
+                    rows_saved += 1
+
+                    record_id = row['$recordId']
+                    common.write_row(stream,
+                              schema,
+                              {k: v for k, v in row.items() if k != '$recordId'},
+                              stream_version,
+                              time_extracted)
+                    checkpoints.observe_record(row)
+
+                    state = singer.write_bookmark(state,
+                                                  tap_stream_id,
+                                                  'last_record_id',
+                                                  common.class_to_string(record_id,
+                                                                         record_id.__class__.__name__))
+                    state = singer.write_bookmark(state,
+                                                  tap_stream_id,
+                                                  'last_record_id_type',
+                                                  record_id.__class__.__name__)
+
+                    if checkpoints.checkpoint():
+                        singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+        except pymongo.errors.OperationFailure as ex:
+            if is_snapshot_error(ex, snapshot_ts, tap_stream_id):
+                snapshot_ts = None
+                continue
+            if last_record_id is not None and ex.code == KEY_NOT_FOUND:
+                LOGGER.warning('Unable to resume %s after record id %s (%s), restarting the scan',
+                               tap_stream_id, last_record_id, ex)
+                singer.clear_bookmark(state, tap_stream_id, 'last_record_id')
+                singer.clear_bookmark(state, tap_stream_id, 'last_record_id_type')
+                continue
+            raise
+
+        return rows_saved
+
+
 # pylint: disable=too-many-locals,invalid-name,too-many-statements
-def sync_collection(client, stream, state, projection):
+def sync_collection(client, stream, state, projection, snapshot_ts=None):
     tap_stream_id = stream['tap_stream_id']
     LOGGER.info('Starting full table sync for %s', tap_stream_id)
 
@@ -30,15 +333,13 @@ def sync_collection(client, stream, state, projection):
     database_name = metadata.get(md_map, (), 'database-name')
 
     db = client[database_name]
-    collection = db[stream['stream']]
+    collection = common.with_raw_bson_decoding(db[stream['stream']])
 
     #before writing the table version to state, check if we had one to begin with
     first_run = singer.get_bookmark(state, stream['tap_stream_id'], 'version') is None
 
-    # last run was interrupted if there is a last_id_fetched bookmark
-    was_interrupted = singer.get_bookmark(state,
-                                          stream['tap_stream_id'],
-                                          'last_id_fetched') is not None
+    partitions = singer.get_bookmark(state, stream['tap_stream_id'], 'partitions')
+    was_interrupted = is_interrupted(state, stream['tap_stream_id'])
 
     #pick a new table version if last run wasn't interrupted
     if was_interrupted:
@@ -74,6 +375,13 @@ def sync_collection(client, stream, state, projection):
                                           stream['tap_stream_id'],
                                           'last_id_fetched')
 
+    if snapshot_ts is not None:
+        # the snapshot can only be read while the server keeps its history, a
+        # sync that takes longer goes on without it
+        LOGGER.info('Reading %s at snapshot %s, the server keeps snapshot history for %s seconds '
+                    '(minSnapshotHistoryWindowInSeconds)',
+                    tap_stream_id, snapshot_ts, common.get_snapshot_history_seconds(client))
+
     if max_id_value:
         # Write the bookmark if max_id_value is defined
         state = singer.write_bookmark(state,
@@ -86,71 +394,37 @@ def sync_collection(client, stream, state, projection):
                                       'max_id_type',
                                       max_id_value.__class__.__name__)
 
-    find_filter = {'$lte': max_id_value}
-    if last_id_fetched:
-        last_id_fetched_type = singer.get_bookmark(state,
-                                                   stream['tap_stream_id'],
-                                                   'last_id_fetched_type')
-        find_filter['$gte'] = common.string_to_class(last_id_fetched, last_id_fetched_type)
-
-    query_message = 'Querying {} with:\n\tFind Parameters: {}'.format(
-        stream['tap_stream_id'],
-        find_filter)
-    if projection:
-        query_message += '\n\tProjection: {}'.format(projection)
-    # pylint: disable=logging-format-interpolation
-    LOGGER.info(query_message)
-
-
-    with collection.find({'_id': find_filter},
-                         projection,
-                         sort=[("_id", pymongo.ASCENDING)]) as cursor:
-        rows_saved = 0
-        time_extracted = utils.now()
-        start_time = time.time()
-
-        schema = {"type": "object", "properties": {}}
-        for row in cursor:
-            rows_saved += 1
-
-            schema_build_start_time = time.time()
-            if common.row_to_schema(schema, row):
-                singer.write_message(singer.SchemaMessage(
-                    stream=common.calculate_destination_stream_name(stream),
-                    schema=schema,
-                    key_properties=['_id']))
-                common.SCHEMA_COUNT[stream['tap_stream_id']] += 1
-            common.SCHEMA_TIMES[stream['tap_stream_id']] += time.time() - schema_build_start_time
-
-            record_message = common.row_to_singer_record(stream,
-                                                         row,
-                                                         stream_version,
-                                                         time_extracted)
-
-            singer.write_message(record_message, allow_nan=True)
-
-            state = singer.write_bookmark(state,
-                                          stream['tap_stream_id'],
-                                          'last_id_fetched',
-                                          common.class_to_string(row['_id'],
-                                                                 row['_id'].__class__.__name__))
-            state = singer.write_bookmark(state,
-                                          stream['tap_stream_id'],
-                                          'last_id_fetched_type',
-                                          row['_id'].__class__.__name__)
-
-
-            if rows_saved % common.UPDATE_BOOKMARK_PERIOD == 0:
-                singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+    partition_count = get_partition_count(stream)
+    if get_scan_order(stream) == 'natural':
+        partition_count = 1
+    if partitions is None and partition_count > 1 and max_id_value is not None and not last_id_fetched:
+        partitions = build_partitions(collection, max_id_value, partition_count)
+        state = singer.write_bookmark(state, stream['tap_stream_id'], 'partitions', partitions)
+        singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+    start_time = time.time()
+    if get_scan_order(stream) == 'natural' and partitions is None and not last_id_fetched:
+        rows_saved = sync_natural_order(collection, stream, state, projection,
+                                        stream_version, snapshot_ts)
+    elif partitions is not None:
+        LOGGER.info('Syncing %s in %s partitions', tap_stream_id, len(partitions))
+        rows_saved = sync_partitions(collection, stream, state, projection, partitions,
+                                     stream_version, snapshot_ts)
+    else:
+        rows_saved = sync_id_range(collection, stream, state, projection, max_id_value,
+                                   stream_version, snapshot_ts)
 
-        common.COUNTS[tap_stream_id] += rows_saved
-        common.TIMES[tap_stream_id] += time.time()-start_time
+    common.COUNTS[tap_stream_id] += rows_saved
+    common.TIMES[tap_stream_id] += time.time()-start_time
 
     # clear max pk value and last pk fetched upon successful sync
     singer.clear_bookmark(state, stream['tap_stream_id'], 'max_id_value')
     singer.clear_bookmark(state, stream['tap_stream_id'], 'max_id_type')
     singer.clear_bookmark(state, stream['tap_stream_id'], 'last_id_fetched')
     singer.clear_bookmark(state, stream['tap_stream_id'], 'last_id_fetched_type')
+    singer.clear_bookmark(state, stream['tap_stream_id'], 'partitions')
+    singer.clear_bookmark(state, stream['tap_stream_id'], 'last_record_id')
+    singer.clear_bookmark(state, stream['tap_stream_id'], 'last_record_id_type')
 
     state = singer.write_bookmark(state,
                                   stream['tap_stream_id'],
@@ -159,4 +433,4 @@ def sync_collection(client, stream, state, projection):
 
     singer.write_message(activate_version_message)
 
-    LOGGER.info('Synced {} records for {}'.format(rows_saved, tap_stream_id))
+    LOGGER.info('Synced %s records for %s', rows_saved, tap_stream_id)
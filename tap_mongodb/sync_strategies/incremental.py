@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 import copy
+import datetime
+import math
 import time
+import bson
+from bson import objectid
 import pymongo
 import singer
 from singer import metadata, utils
@@ -8,9 +12,34 @@ import tap_mongodb.sync_strategies.common as common
 
 LOGGER = singer.get_logger()
 
+# the query planner merges at most this many index scans to provide a sort
+MAX_SORT_MERGE_SCANS = 200
+
+
+def update_bookmark(row, state, tap_stream_id, replication_key_name, tiebreak=False):
+    write_replication_key_bookmark(state,
+                                   tap_stream_id,
+                                   row.get(replication_key_name),
+                                   row['_id'] if tiebreak else None)
+
+
+def write_replication_key_bookmark(state, tap_stream_id, replication_key_value, last_id=None):
+    # the _id of the last document emitted with replication_key_value, if the
+    # documents are read in (replication key, _id) order
+    if last_id is None:
+        singer.clear_bookmark(state, tap_stream_id, 'replication_key_last_id')
+        singer.clear_bookmark(state, tap_stream_id, 'replication_key_last_id_type')
+    else:
+        last_id_type = last_id.__class__.__name__
+        state = singer.write_bookmark(state,
+                                      tap_stream_id,
+                                      'replication_key_last_id',
+                                      common.class_to_string(last_id, last_id_type))
+        state = singer.write_bookmark(state,
+                                      tap_stream_id,
+                                      'replication_key_last_id_type',
+                                      last_id_type)
 
-def update_bookmark(row, state, tap_stream_id, replication_key_name):
-    replication_key_value = row.get(replication_key_name)
     if replication_key_value:
         replication_key_type = replication_key_value.__class__.__name__
 
@@ -25,13 +54,369 @@ def update_bookmark(row, state, tap_stream_id, replication_key_name):
                                       'replication_key_type',
                                       replication_key_type)
 
+def is_usable_index(index_info):
+    # partial, sparse and collated indexes do not cover every document, and
+    # special (text, hashed, geo) indexes are not ordered
+    return (not index_info.get('partialFilterExpression')
+            and not index_info.get('sparse')
+            and not index_info.get('collation')
+            and all(direction in (1, -1) for _, direction in index_info['key']))
+
+
+def has_id_tiebreak(keys, position):
+    # the index orders documents with the same replication key by ascending _id
+    return (len(keys) > position + 1
+            and keys[position + 1][0] == '_id'
+            and keys[position + 1][1] == keys[position][1])
+
+
+def get_index_plan(collection, replication_key_name, prefix_scans=False):
+    '''
+    Find an index that returns documents in replication key order and return the
+    hint, sort and extra filter to use it with. An index led by the replication key
+    is used as is, and preferred. With prefix_scans, an index whose second field
+    is the replication key is used by matching every value of its first field, so
+    the server merges one ordered index scan per value instead of sorting the
+    collection, as long as there are fewer than MAX_SORT_MERGE_SCANS of them.
+    Indexes that follow the replication key with _id are preferred, since they let
+    documents that share a replication key value be resumed by _id.
+    '''
+    candidates = []
+    for name, info in collection.index_information().items():
+        if not is_usable_index(info):
+            continue
+        keys = info['key']
+        for position in (0, 1):
+            if len(keys) > position and keys[position][0] == replication_key_name:
+                candidates.append((position, not has_id_tiebreak(keys, position), name, keys))
+
+    for position, _, name, keys in sorted(candidates, key=lambda candidate: candidate[:2]):
+        sort = [(replication_key_name, pymongo.ASCENDING)]
+        if has_id_tiebreak(keys, position):
+            sort.append(('_id', pymongo.ASCENDING))
+
+        if position == 0:
+            return {'hint': name, 'filter': {}, 'sort': sort}
+        if not prefix_scans:
+            continue
+
+        prefix_field = keys[0][0]
+        prefix_values = collection.distinct(prefix_field)
+        if len(prefix_values) >= MAX_SORT_MERGE_SCANS:
+            LOGGER.warning('Not using index %s for %s, %s has more than %s values',
+                           name, replication_key_name, prefix_field, MAX_SORT_MERGE_SCANS)
+            continue
+        # None also matches documents where the prefix field is missing
+        return {'hint': name, 'filter': {prefix_field: {'$in': prefix_values + [None]}}, 'sort': sort}
+
+    LOGGER.warning('No index found for replication key %s, the collection will be scanned and sorted',
+                   replication_key_name)
+    return {'hint': None, 'filter': {}, 'sort': [(replication_key_name, pymongo.ASCENDING)]}
+
+
+def get_bounded_index_plan(collection, replication_key_name, index_plan, upper):
+    '''
+    Return the index plan to read up to upper with. The prefix values of a
+    compound index are read again once the upper bound is taken, so they include
+    those of every document up to it. Without an upper bound, documents written
+    during the run with a new prefix value could be passed by the bookmark, and
+    the prefix scans are not used.
+    '''
+    if not index_plan['filter']:
+        return index_plan
+    if upper is None:
+        LOGGER.warning('Not merging the scans of index %s for %s since the run has no upper bound',
+                       index_plan['hint'], replication_key_name)
+    return get_index_plan(collection, replication_key_name, prefix_scans=upper is not None)
+
+
+def has_tiebreak(index_plan):
+    return len(index_plan['sort']) > 1
+
+
+def get_replication_key_filter(replication_key_name, condition, last_id=None):
+    '''
+    Build the filter for condition on the replication key. If the lower bound was
+    bookmarked along with the _id of the last document emitted at that value, the
+    lower bound becomes rk > value OR (rk == value AND _id > last_id), so
+    documents that share the bookmarked value are not emitted again.
+    '''
+    if last_id is None or '$gte' not in condition:
+        return {replication_key_name: condition}
+
+    lower = condition['$gte']
+    after_lower = {k: v for k, v in condition.items() if k != '$gte'}
+    after_lower['$gt'] = lower
+    return {'$or': [{replication_key_name: after_lower},
+                    {replication_key_name: lower, '_id': {'$gt': last_id}}]}
+
+
+def get_max_replication_key_value(collection, replication_key_name, index_plan=None):
+    index_plan = index_plan or {'hint': None, 'filter': {}}
+    # covered by the replication key index
+    row = collection.find_one(index_plan['filter'],
+                              sort=[(replication_key_name, pymongo.DESCENDING)],
+                              projection={replication_key_name: 1, '_id': 0},
+                              hint=index_plan['hint'])
+    if not row:
+        return None
+    return row.get(replication_key_name)
+
+
+def to_comparable(value):
+    # the client decodes naive UTC datetimes while bookmarks are timezone aware
+    if isinstance(value, datetime.datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def is_after(value, other):
+    '''
+    Whether value sorts after other. Values of different types are never
+    compared, since the server only matches range queries within one type.
+    '''
+    if value is None or other is None or value.__class__ != other.__class__:
+        return False
+    return to_comparable(value) > to_comparable(other)
+
+
+def get_window_size(stream_metadata):
+    window_size = stream_metadata.get('tap-mongodb.incremental-window')
+    if window_size is None or window_size == '':
+        return None
+    # metadata set by hand or through a UI can hold the number as a string
+    try:
+        window_size = float(window_size)
+    except (TypeError, ValueError):
+        window_size = None
+    if window_size is None or not math.isfinite(window_size):
+        raise Exception("tap-mongodb.incremental-window must be a number (you passed {})"
+                        .format(stream_metadata.get('tap-mongodb.incremental-window')))
+    if window_size <= 0:
+        return None
+    # whole windows stay integers, so integer replication keys stay integers
+    if window_size.is_integer():
+        return int(window_size)
+    return window_size
+
+
+def get_window_upper_bound(lower, window_size):
+    '''
+    Return the end of a window of window_size starting at lower. Numbers are
+    advanced by window_size, datetimes, ObjectIds and Timestamps by window_size
+    seconds. Integers, ObjectIds and Timestamps have whole units, the window is
+    rounded up to one so it always ends past lower. Returns None for replication
+    key types that have no such distance.
+    '''
+    if isinstance(lower, bool):
+        return None
+    if isinstance(lower, (int, float)):
+        if isinstance(lower, int):
+            window_size = math.ceil(window_size)
+        return lower.__class__(lower + window_size)
+    if isinstance(lower, datetime.datetime):
+        # naive UTC, like the datetimes decoded from the server
+        upper = to_comparable(lower) + datetime.timedelta(seconds=window_size)
+        return upper.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if isinstance(lower, objectid.ObjectId):
+        return objectid.ObjectId.from_datetime(lower.generation_time
+                                               + datetime.timedelta(seconds=math.ceil(window_size)))
+    if isinstance(lower, bson.timestamp.Timestamp):
+        return bson.timestamp.Timestamp(lower.time + math.ceil(window_size), 0)
+    return None
+
+
+def get_upper_bound(collection, replication_key_name, lower, index_plan, window_size=None):
+    '''
+    Return the highest replication key value this run syncs up to: the max value
+    when the run starts, or the end of the window after lower if that is earlier.
+    Documents written past it while the run is in progress are left for the next
+    run, so the sorted cursor does not keep chasing them.
+    '''
+    upper = get_max_replication_key_value(collection, replication_key_name, index_plan)
+    if not is_after(upper, lower):
+        return None
+
+    if window_size:
+        window_upper = get_window_upper_bound(lower, window_size)
+        if window_upper is None:
+            LOGGER.warning('Ignoring tap-mongodb.incremental-window, %s replication keys are not supported',
+                           lower.__class__.__name__)
+        elif is_after(upper, window_upper):
+            upper = window_upper
+    return upper
+
+
+def get_chunk_count(stream_metadata):
+    chunk_count = stream_metadata.get('tap-mongodb.incremental-chunks')
+    if not chunk_count:
+        return 1
+    return max(int(chunk_count), 1)
+
+
+def build_chunks(collection, replication_key_name, lower, upper, chunk_count):
+    '''
+    Split [lower, upper] into chunk_count replication key ranges of roughly equal
+    size, using boundaries sampled from the documents in between.
+    '''
+    boundaries = common.sample_boundaries(collection,
+                                          replication_key_name,
+                                          {replication_key_name: {'$gte': lower, '$lte': upper}},
+                                          chunk_count,
+                                          upper.__class__.__name__)
+    boundaries = [b for b in boundaries if is_after(b, lower) and is_after(upper, b)]
+
+    lower_bounds = [lower] + boundaries
+    upper_bounds = boundaries + [upper]
+    chunks = [{'$gte': chunk_lower, '$lt': chunk_upper}
+              for chunk_lower, chunk_upper in zip(lower_bounds, upper_bounds)]
+    chunks[-1] = {'$gte': lower_bounds[-1], '$lte': upper}
+    return chunks
+
+
+def get_chunk_bookmark(chunks, positions, completed, start):
+    '''
+    Return the (replication key value, _id) position that is safe to resume from:
+    every document before it has been emitted. That is the last position read in
+    the first chunk that has not completed, or the start of that chunk if nothing
+    was read from it yet.
+    '''
+    for index, chunk in enumerate(chunks):
+        if not completed[index]:
+            if positions[index] is not None:
+                return positions[index]
+            return start if index == 0 else (chunk['$gte'], None)
+
+    for position in reversed(positions):
+        if position is not None:
+            return position
+    return start
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments, too-many-locals
+def sync_chunks(collection, stream, state, projection, chunks, stream_version, index_plan, last_id=None):
+    tap_stream_id = stream['tap_stream_id']
+    replication_key_name = metadata.to_map(stream['metadata']).get(()).get('replication-key')
+    tiebreak = has_tiebreak(index_plan)
+
+    def chunk_filter(index):
+        chunk_last_id = last_id if index == 0 else None
+        return dict(index_plan['filter'],
+                    **get_replication_key_filter(replication_key_name, chunks[index], chunk_last_id))
+
+    def cursor_factory(index):
+        return lambda: collection.find(chunk_filter(index),
+                                       projection,
+                                       sort=index_plan['sort'],
+                                       hint=index_plan['hint'])
+
+    for index, _ in enumerate(chunks):
+        LOGGER.info('Querying %s chunk with:\n\tFind Parameters: %s\n\tHint: %s',
+                    tap_stream_id,
+                    chunk_filter(index),
+                    index_plan['hint'])
+
+    # the (replication key value, _id) of the last document read from each chunk
+    positions = [None] * len(chunks)
+    completed = [False] * len(chunks)
+    start = (chunks[0]['$gte'], last_id)
+
+    rows_saved = 0
+    checkpoints = common.CheckpointScheduler()
+    time_extracted = utils.now()
+    schema = {"type": "object", "properties": {}}
+    for index, row in common.read_cursors_in_parallel([cursor_factory(i) for i, _ in enumerate(chunks)],
+                                                      tap_stream_id=tap_stream_id):
+        if row is common.CURSOR_EXHAUSTED:
+            completed[index] = True
+        else:
+            common.write_row(stream, schema, row, stream_version, time_extracted)
+            checkpoints.observe_record(row)
+            rows_saved += 1
+            positions[index] = (row.get(replication_key_name), row['_id'] if tiebreak else None)
+
+        # only advance the bookmark over the chunks that have completed
+        write_replication_key_bookmark(state,
+                                       tap_stream_id,
+                                       *get_chunk_bookmark(chunks, positions, completed, start))
+
+        if row is common.CURSOR_EXHAUSTED or checkpoints.checkpoint():
+            singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+    return rows_saved
+
+
+def get_change_fingerprint(collection, replication_key_name):
+    '''
+    Return the max replication key value and the number of documents that have
+    it. Both come from the replication key index, and any document written with
+    a replication key at or past the bookmark changes one of them.
+    '''
+    index_plan = get_index_plan(collection, replication_key_name)
+    max_value = get_max_replication_key_value(collection, replication_key_name, index_plan)
+    if max_value is None:
+        return 'empty'
+
+    max_value_type = max_value.__class__.__name__
+    try:
+        max_value_string = common.class_to_string(max_value, max_value_type)
+    except common.UnsupportedReplicationKeyTypeException:
+        return None
+
+    max_value_filter = dict(index_plan['filter'], **{replication_key_name: max_value})
+    if index_plan['hint']:
+        max_value_count = collection.count_documents(max_value_filter, hint=index_plan['hint'])
+    else:
+        max_value_count = collection.count_documents(max_value_filter)
+    return '{}:{}:{}'.format(max_value_type, max_value_string, max_value_count)
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def sync_query(collection, stream, state, projection, find_filter, stream_version, index_plan):
+    tap_stream_id = stream['tap_stream_id']
+    replication_key_name = metadata.to_map(stream['metadata']).get(()).get('replication-key')
+
+    find_filter = dict(index_plan['filter'], **find_filter)
+
+    # log query
+    query_message = 'Querying {} with:\n\tFind Parameters: {}'.format(tap_stream_id, find_filter)
+    if projection:
+        query_message += '\n\tProjection: {}'.format(projection)
+    if index_plan['hint']:
+        query_message += '\n\tHint: {}'.format(index_plan['hint'])
+    LOGGER.info(query_message)
+
+
+    # query collection
+    schema = {"type": "object", "properties": {}}
+    with collection.find(find_filter,
+                         projection,
+                         sort=index_plan['sort'],
+                         hint=index_plan['hint']) as cursor:
+        rows_saved = 0
+        checkpoints = common.CheckpointScheduler()
+        time_extracted = utils.now()
+
+        for row in common.iterate_cursor(cursor, tap_stream_id):
+            common.write_row(stream, schema, row, stream_version, time_extracted)
+            checkpoints.observe_record(row)
+            rows_saved += 1
+
+            update_bookmark(row, state, tap_stream_id, replication_key_name, has_tiebreak(index_plan))
+
+            if checkpoints.checkpoint():
+                singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+
+    return rows_saved
+
+
 # pylint: disable=too-many-locals, too-many-statements
 def sync_collection(client, stream, state, projection):
     tap_stream_id = stream['tap_stream_id']
     LOGGER.info('Starting incremental sync for %s', tap_stream_id)
 
     stream_metadata = metadata.to_map(stream['metadata']).get(())
-    collection = client[stream_metadata['database-name']][stream['stream']]
+    collection = common.with_raw_bson_decoding(client[stream_metadata['database-name']][stream['stream']])
 
     #before writing the table version to state, check if we had one to begin with
     first_run = singer.get_bookmark(state, stream['tap_stream_id'], 'version') is None
@@ -67,61 +452,65 @@ def sync_collection(client, stream, state, projection):
     # write state message
     singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
 
-    # create query
-    find_filter = {}
+    # only a run from a bookmark has an upper bound to merge prefix scans up to
+    index_plan = get_index_plan(collection, replication_key_name, prefix_scans=bool(replication_key_value_bookmark))
+
+    lower = None
+    upper = None
     if replication_key_value_bookmark:
-        find_filter[replication_key_name] = {}
-        find_filter[replication_key_name]['$gte'] = \
-            common.string_to_class(replication_key_value_bookmark,
-                                   stream_state.get('replication_key_type'))
+        lower = common.string_to_class(replication_key_value_bookmark,
+                                       stream_state.get('replication_key_type'))
+        # the first run is not bounded, a range on the replication key would skip
+        # documents where it is missing or of another type
+        upper = get_upper_bound(collection,
+                                replication_key_name,
+                                lower,
+                                index_plan,
+                                get_window_size(stream_metadata))
 
-    # log query
-    query_message = 'Querying {} with:\n\tFind Parameters: {}'.format(tap_stream_id, find_filter)
-    if projection:
-        query_message += '\n\tProjection: {}'.format(projection)
-    LOGGER.info(query_message)
+    index_plan = get_bounded_index_plan(collection, replication_key_name, index_plan, upper)
 
+    # documents sharing the bookmarked replication key value are resumed after the
+    # bookmarked _id, as long as they are still read in _id order
+    last_id = None
+    if has_tiebreak(index_plan) and stream_state.get('replication_key_last_id') is not None:
+        last_id = common.string_to_class(stream_state['replication_key_last_id'],
+                                         stream_state.get('replication_key_last_id_type'))
 
-    # query collection
-    schema = {"type": "object", "properties": {}}
-    with collection.find(find_filter,
-                         projection,
-                         sort=[(replication_key_name, pymongo.ASCENDING)]) as cursor:
-        rows_saved = 0
-        time_extracted = utils.now()
-        start_time = time.time()
-
-        for row in cursor:
-            schema_build_start_time = time.time()
-            if common.row_to_schema(schema, row):
-                singer.write_message(singer.SchemaMessage(
-                    stream=common.calculate_destination_stream_name(stream),
-                    schema=schema,
-                    key_properties=['_id']))
-                common.SCHEMA_COUNT[tap_stream_id] += 1
-            common.SCHEMA_TIMES[tap_stream_id] += time.time() - schema_build_start_time
-
-
-            record_message = common.row_to_singer_record(stream,
-                                                         row,
-                                                         stream_version,
-                                                         time_extracted)
-
-            # gen_schema = common.row_to_schema_message(schema, record_message.record, row)
-            # if DeepDiff(schema, gen_schema, ignore_order=True) != {}:
-            #   emit gen_schema
-            #   schema = gen_schema
-            singer.write_message(record_message, allow_nan=True)
-            rows_saved += 1
+    # create query
+    find_filter = {}
+    if replication_key_value_bookmark:
+        condition = {'$gte': lower}
+        if upper is not None:
+            condition['$lte'] = upper
+            LOGGER.info('Syncing %s up to %s %s', tap_stream_id, replication_key_name, upper)
+        find_filter = get_replication_key_filter(replication_key_name, condition, last_id)
 
-            update_bookmark(row, state, tap_stream_id, replication_key_name)
+    start_time = time.time()
 
-            if rows_saved % common.UPDATE_BOOKMARK_PERIOD == 0:
-                singer.write_message(singer.StateMessage(value=copy.deepcopy(state)))
+    # split a backlog between the bookmark and the upper bound into chunks that
+    # are read concurrently
+    chunks = None
+    chunk_count = get_chunk_count(stream_metadata)
+    if chunk_count > 1 and upper is not None:
+        chunks = build_chunks(collection, replication_key_name, lower, upper, chunk_count)
+
+    if chunks:
+        rows_saved = sync_chunks(collection, stream, state, projection, chunks, stream_version, index_plan, last_id)
+    else:
+        rows_saved = sync_query(collection, stream, state, projection, find_filter, stream_version, index_plan)
 
+    # every document up to the upper bound has been read, so the next run can start
+    # there even if no document was found close to it, e.g. in an empty window
+    if upper is not None:
+        stream_state = state['bookmarks'][tap_stream_id]
+        bookmarked_value = common.string_to_class(stream_state['replication_key_value'],
+                                                  stream_state['replication_key_type'])
+        if is_after(upper, bookmarked_value):
+            write_replication_key_bookmark(state, tap_stream_id, upper)
 
-        common.COUNTS[tap_stream_id] += rows_saved
-        common.TIMES[tap_stream_id] += time.time()-start_time
+    common.COUNTS[tap_stream_id] += rows_saved
+    common.TIMES[tap_stream_id] += time.time()-start_time
 
     singer.write_message(activate_version_message)
 
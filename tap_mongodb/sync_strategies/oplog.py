@@ -1,40 +1,165 @@
 #!/usr/bin/env python3
+import collections
+import concurrent.futures
+import itertools
+import json
+import queue
+import threading
 import time
 import pymongo
 import singer
 from singer import metadata, utils
-from pymongo.errors import ConfigurationError
 
+import bson
 from bson import timestamp
 import tap_mongodb.sync_strategies.common as common
 
 LOGGER = singer.get_logger()
 
 SDC_DELETED_AT = "_sdc_deleted_at"
-MAX_UPDATE_BUFFER_LENGTH = 500
+INITIAL_UPDATE_BUFFER_LENGTH = 500
+MIN_UPDATE_BUFFER_LENGTH = 1
+MAX_UPDATE_BUFFER_LENGTH = 10000
+# size budget of the _ids in a lookup's $in, well under the 16 MB command limit
+MAX_LOOKUP_QUERY_BYTES = 1024 * 1024
+# how long a tailable oplog cursor waits for new entries, and how often the
+# update buffers are flushed while tailing
+TAIL_AWAIT_TIME_MS = 1000
+TAIL_FLUSH_SECONDS = 1
+# wait before reopening a closed tailable cursor, doubled on every reopen
+# without new entries
+TAIL_REOPEN_SECONDS = 1
+MAX_TAIL_REOPEN_SECONDS = 60
+# memory for the operations of the transactions of a shard that have not
+# committed yet, beyond which their entries are read again at commit
+MAX_TRANSACTION_BUFFER_BYTES = 16 * 1024 * 1024
+# entries of each shard oplog read ahead of the merge of the shard oplogs
+MERGE_BUFFER_SIZE = 1000
+# fields of the oplog entries of transactions
+# the client and its server versionArray by id(client), read once per run
+SERVER_VERSIONS = {}
+
+TRANSACTION_FIELDS = ['o.applyOps', 'o.partialTxn', 'o.prepare', 'o.commitTransaction', 'o.abortTransaction']
 
 def get_latest_ts(client):
     row = client.local.oplog.rs.find_one(sort=[('$natural', pymongo.DESCENDING)])
     return row.get('ts')
 
 
+def get_earliest_ts(client):
+    row = client.local.oplog.rs.find_one(sort=[('$natural', pymongo.ASCENDING)])
+    return row.get('ts')
+
+
+def get_oplog_clients(client):
+    '''
+    The clients to read the oplog with, by shard: one for the replica set of each
+    shard of a sharded cluster (see SHARD_CLIENTS), or client as the None shard.
+    '''
+    return common.SHARD_CLIENTS or {None: client}
+
+
+def get_cluster_latest_ts(client):
+    # the oplog of every shard has reached it, later writes have a later ts on
+    # any shard
+    return min(get_latest_ts(oplog_client) for oplog_client in get_oplog_clients(client).values())
+
+
 def oplog_has_aged_out(client, state, tap_stream_id):
-    earliest_ts_row = client.local.oplog.rs.find_one(sort=[('$natural', pymongo.ASCENDING)])
+    for shard, oplog_client in get_oplog_clients(client).items():
+        bookmarked_ts = get_bookmarked_ts(state, tap_stream_id, shard)
+        if bookmarked_ts is None:
+            return False
+
+        if bookmarked_ts < get_earliest_ts(oplog_client):
+            return True
+
+    return False
+
+
+def get_oplog_window(client):
+    '''
+    Measure the oplog from its first and last entries: the seconds of history it
+    holds, how fast it grows, and how many seconds of history it will hold once
+    it reaches its maximum size and starts dropping its oldest entries.
+    '''
+    first_ts = client.local.oplog.rs.find_one(sort=[('$natural', pymongo.ASCENDING)])['ts']
+    last_ts = get_latest_ts(client)
+    stats = client.local.command('collStats', 'oplog.rs')
+
+    window_seconds = max(last_ts.time - first_ts.time, 1)
+    bytes_per_second = stats['size'] / window_seconds
+    capacity_seconds = window_seconds
+    if bytes_per_second and stats.get('maxSize'):
+        capacity_seconds = max(window_seconds, stats['maxSize'] / bytes_per_second)
+
+    return {'first_ts': first_ts,
+            'last_ts': last_ts,
+            'window_seconds': window_seconds,
+            'bytes_per_second': bytes_per_second,
+            'capacity_seconds': capacity_seconds}
+
+
+def get_seconds_until_aged_out(oplog_window, bookmarked_ts):
+    '''
+    Project how long until bookmarked_ts falls off the oplog, if the oplog keeps
+    growing at its current rate. Negative once it has aged out.
+    '''
+    return bookmarked_ts.time + oplog_window['capacity_seconds'] - oplog_window['last_ts'].time
 
-    earliest_ts = earliest_ts_row.get('ts')
 
-    stream_state = state.get('bookmarks', {}).get(tap_stream_id)
-    if not stream_state or not stream_state.get('oplog_ts_time'):
-        return False
+def forecast_aged_out(client, state, tap_stream_ids):
+    '''
+    Return the seconds until the bookmark of each of tap_stream_ids ages out of
+    the oplog of any shard.
+    '''
+    forecast = {}
+    for shard, oplog_client in get_oplog_clients(client).items():
+        oplog_window = get_oplog_window(oplog_client)
+        LOGGER.info('Oplog%s holds %.0f seconds of history, grows %.0f bytes/second and holds %.0f seconds when full',
+                    ' of shard {}'.format(shard) if shard is not None else '', oplog_window['window_seconds'],
+                    oplog_window['bytes_per_second'], oplog_window['capacity_seconds'])
+
+        for tap_stream_id in tap_stream_ids:
+            seconds = get_seconds_until_aged_out(oplog_window, get_bookmarked_ts(state, tap_stream_id, shard))
+            forecast[tap_stream_id] = min(seconds, forecast.get(tap_stream_id, seconds))
+    return forecast
 
-    bookmarked_ts = timestamp.Timestamp(stream_state['oplog_ts_time'],
-                                        stream_state['oplog_ts_inc'])
 
-    return bookmarked_ts < earliest_ts
+def use_oplog_replay(client):
+    '''
+    Whether the oplog query needs the oplogReplay flag to seek to its ts lower
+    bound instead of scanning the oplog from its start. The seek only depends on
+    the ts predicate and the $natural order, not on the projection. MongoDB 4.4+
+    seeks by itself and deprecates the flag.
+    '''
+    cached_client, version = SERVER_VERSIONS.get(id(client), (None, None))
+    # the client is kept with its version so a reused id is not a hit
+    if cached_client is not client:
+        version = client.server_info().get('versionArray', [])
+        SERVER_VERSIONS[id(client)] = (client, version)
+    return tuple(version[:2]) < (4, 4)
+
+
+def get_bookmarked_ts(state, tap_stream_id, shard=None):
+    stream_state = state.get('bookmarks', {}).get(tap_stream_id, {})
+    # the shards of a sharded cluster fall back to the bookmark of the stream
+    # until they have their own
+    stream_state = stream_state.get('shards', {}).get(shard, stream_state)
+    if stream_state.get('oplog_ts_time') is None:
+        return None
+
+    return timestamp.Timestamp(stream_state['oplog_ts_time'],
+                               stream_state['oplog_ts_inc'])
 
 
 # pylint: disable=invalid-name
-def update_bookmarks(state, tap_stream_id, ts):
+def update_bookmarks(state, tap_stream_id, ts, shard=None):
+    if shard is not None:
+        shards = singer.get_bookmark(state, tap_stream_id, 'shards', {})
+        shards[shard] = {'oplog_ts_time': ts.time, 'oplog_ts_inc': ts.inc}
+        return singer.write_bookmark(state, tap_stream_id, 'shards', shards)
+
     state = singer.write_bookmark(state,
                                   tap_stream_id,
                                   'oplog_ts_time',
@@ -60,7 +185,7 @@ def write_schema(schema, row, stream):
 
 def transform_projection(projection):
     base_projection = {
-        "ts": 1, "ns": 1, "op": 1, 'o2': 1
+        "ts": 1, "ns": 1, "op": 1, 'o2': 1, 'lsid': 1, 'txnNumber': 1
     }
     new_projection = {}
 
@@ -81,7 +206,8 @@ def transform_projection(projection):
         # If only '_id' is whitelisted, return base projection with 'o._id' whitelisted
         new_projection = base_projection
         new_projection['o._id'] = 1
-        new_projection['o.applyOps'] = 1
+        for field in TRANSACTION_FIELDS:
+            new_projection[field] = 1
         return new_projection
 
     # If whitelist is provided, return base projection along
@@ -91,7 +217,8 @@ def transform_projection(projection):
         for field, value in temp_projection.items():
             new_projection['o.' + field] = value
         new_projection['o._id'] = 1
-        new_projection['o.applyOps'] = 1
+        for field in TRANSACTION_FIELDS:
+            new_projection[field] = 1
         return new_projection
 
     # If blacklist is provided, return blacklisted fields with _id whitelisted
@@ -106,27 +233,44 @@ def flush_buffer(client, update_buffer, stream_projection, db_name, collection_n
         for row in cursor:
             yield row
 
-class SessionNotAvailable():
-    def __enter__(self, *args):
-        pass
-    def __exit__(self, *args):
-        pass
-
-def maybe_get_session(client):
+def get_update_delta(row):
     '''
-    Try to get a session. If sessions are not available to us then return an object
-    that will work in the context manager
+    Return the changes of an update oplog entry as a partial document: the _id,
+    the top level fields the update sets and None for the fields it removes. A
+    replacement returns the whole new document. Returns None for updates of
+    nested fields or array elements, which need the whole document to be looked up.
     '''
-    try:
-        return client.start_session()
-    except ConfigurationError:
-        # log sessions not available
-        LOGGER.info('Unable to start session, without session')
-        # return an object that works with a 'with' block
-        return SessionNotAvailable()
+    update = row['o']
+
+    if update.get('$v') == 2:
+        # delta oplog entries (MongoDB 5.0+): u(pdate), i(nsert) and d(elete) list
+        # the changed top level fields, s<field> and a keys change nested ones
+        diff = update['diff']
+        if any(key not in ('u', 'i', 'd') for key in diff):
+            return None
+        delta = dict(diff.get('u', {}), **diff.get('i', {}))
+        delta.update({field: None for field in diff.get('d', {})})
+
+    elif any(key.startswith('$') for key in update):
+        if any(key not in ('$v', '$set', '$unset') for key in update):
+            return None
+        delta = dict(update.get('$set', {}))
+        delta.update({field: None for field in update.get('$unset', {})})
+        # dotted paths set nested fields or array elements
+        if any('.' in field for field in delta):
+            return None
+
+    else:
+        # a replacement, o is the whole new document
+        return update
+
+    delta['_id'] = row['o2']['_id']
+    return delta
+
 
 # pylint: disable=too-many-arguments, too-many-positional-arguments
-def process_row(schema, row, stream, update_buffer, rows_saved, version, time_extracted, current_namespace):
+def process_row(schema, row, stream, update_buffer, rows_saved, version, time_extracted, current_namespace,
+                apply_update_deltas=False):
     row_op = row['op']
     if row.get("ns") != current_namespace:
         # skip rows that are not for the current namespace
@@ -143,7 +287,22 @@ def process_row(schema, row, stream, update_buffer, rows_saved, version, time_ex
         rows_saved += 1
 
     elif row_op == 'u':
-        update_buffer.add(row['o2']['_id'])
+        # a document that will be looked up is emitted with all its changes
+        delta = None
+        if apply_update_deltas and row['o2']['_id'] not in update_buffer:
+            delta = get_update_delta(row)
+
+        if delta is None:
+            update_buffer.add(row['o2']['_id'])
+        else:
+            write_schema(schema, delta, stream)
+            record_message = common.row_to_singer_record(stream,
+                                                        delta,
+                                                        version,
+                                                        time_extracted)
+            singer.write_message(record_message, allow_nan=True)
+
+            rows_saved += 1
 
     elif row_op == 'd':
 
@@ -165,169 +324,648 @@ def process_row(schema, row, stream, update_buffer, rows_saved, version, time_ex
 
     return (rows_saved, update_buffer)
 
-# pylint: disable=too-many-locals, too-many-branches, too-many-statements
-def sync_collection(client, stream, state, stream_projection, max_oplog_ts=None):
-    tap_stream_id = stream['tap_stream_id']
-    LOGGER.info('Starting oplog sync for %s', tap_stream_id)
-
-    md_map = metadata.to_map(stream['metadata'])
-    database_name = metadata.get(md_map, (), 'database-name')
-    collection_name = stream.get("table_name")
-    stream_state = state.get('bookmarks', {}).get(tap_stream_id)
-
-    oplog_ts = timestamp.Timestamp(stream_state['oplog_ts_time'],
-                                   stream_state['oplog_ts_inc'])
-
-    # Write activate version message
-    version = common.get_stream_version(tap_stream_id, state)
-    activate_version_message = singer.ActivateVersionMessage(
-        stream=common.calculate_destination_stream_name(stream),
-        version=version
-    )
-    singer.write_message(activate_version_message)
 
-    time_extracted = utils.now()
-    rows_saved = 0
+class UpdateBufferSizer():
+    '''
+    Picks how many _ids the update buffer holds before they are looked up, from
+    the observed lookup latency, size of the documents returned and size of the
+    _ids, so that a lookup stays close to TARGET_BATCH_SECONDS and
+    TARGET_BATCH_BYTES and its query under MAX_LOOKUP_QUERY_BYTES. The length at
+    most doubles between two lookups.
+    '''
+    def __init__(self):
+        self.length = INITIAL_UPDATE_BUFFER_LENGTH
+        self.document_size = None
+        self.id_size = None
+        self.seconds_per_id = None
+
+    @staticmethod
+    def moving_average(average, value):
+        if average is None:
+            return value
+        return 0.8 * average + 0.2 * value
+
+    def observe_lookup(self, id_count, id_size, document_sizes, seconds):
+        if id_count <= 0:
+            return
+        self.id_size = self.moving_average(self.id_size, id_size)
+        self.seconds_per_id = self.moving_average(self.seconds_per_id, seconds / id_count)
+        if document_sizes:
+            self.document_size = self.moving_average(self.document_size,
+                                                     sum(document_sizes) / len(document_sizes))
+
+    def next_length(self):
+        length = min(MAX_UPDATE_BUFFER_LENGTH, self.length * 2)
+        if self.document_size:
+            length = min(length, common.TARGET_BATCH_BYTES / self.document_size)
+        if self.seconds_per_id:
+            length = min(length, common.TARGET_BATCH_SECONDS / self.seconds_per_id)
+        if self.id_size:
+            length = min(length, MAX_LOOKUP_QUERY_BYTES / self.id_size)
+
+        self.length = int(max(MIN_UPDATE_BUFFER_LENGTH, min(length, MAX_UPDATE_BUFFER_LENGTH)))
+        return self.length
+
+
+def look_up_update_buffer(client, update_buffer, stream_projection, db_name, collection_name):
+    '''
+    Return the documents of update_buffer, how long the lookup took and the sizes
+    of a sample of the documents.
+    '''
     start_time = time.time()
+    rows = list(flush_buffer(client, update_buffer, stream_projection, db_name, collection_name))
+    seconds = time.time() - start_time
+    document_sizes = [common.get_document_size(row) for row in rows[::common.DOCUMENT_SIZE_SAMPLE_PERIOD]]
+    return rows, seconds, document_sizes
+
 
+# pylint: disable=too-many-instance-attributes
+class OplogStream():
+    '''
+    The sync of one LOG_BASED stream within an oplog pass that may be shared
+    with other streams.
+    '''
+    def __init__(self, stream, state, stream_projection):
+        self.stream = stream
+        self.tap_stream_id = stream['tap_stream_id']
+        md_map = metadata.to_map(stream['metadata'])
+        self.database_name = metadata.get(md_map, (), 'database-name')
+        self.collection_name = stream.get("table_name")
+        self.namespace = '{}.{}'.format(self.database_name, self.collection_name)
+        self.stream_projection = stream_projection
+        self.oplog_ts = get_bookmarked_ts(state, self.tap_stream_id)
+        self.version = common.get_stream_version(self.tap_stream_id, state)
+        self.schema = {"type": "object", "properties": {}}
+        self.update_buffer = set()
+        # (update buffer, future of its lookup) in the order they were issued
+        self.pending_lookups = collections.deque()
+        self.update_buffer_sizer = UpdateBufferSizer()
+        # shared by the streams of an oplog pass
+        self.checkpoints = common.CheckpointScheduler()
+        self.lag = common.LagReporter(self.tap_stream_id)
+        self.rows_saved = 0
+        # a projected oplog query strips the update operators from o
+        self.apply_update_deltas = common.APPLY_UPDATE_DELTAS and stream_projection is None
+
+    def process_row(self, row, time_extracted):
+        rows_saved = self.rows_saved
+        self.rows_saved, self.update_buffer = process_row(self.schema, row, self.stream, self.update_buffer,
+                                                          self.rows_saved, self.version, time_extracted,
+                                                          self.namespace, self.apply_update_deltas)
+        self.lag.observe_oplog_entry()
+        if self.rows_saved > rows_saved:
+            self.checkpoints.observe_record(row.get('o'))
+            self.lag.observe_records(self.rows_saved - rows_saved)
+
+    def is_update_buffer_full(self):
+        return len(self.update_buffer) >= self.update_buffer_sizer.length
+
+    def flush(self, client, executor):
+        '''
+        Look up the documents in the update buffer on executor, so the oplog keeps
+        being read while the lookup runs. Its documents are written by write_lookups.
+        '''
+        if not self.update_buffer:
+            return
+
+        update_buffer = self.update_buffer
+        self.update_buffer = set()
+
+        common.record_update_buffer_flush(self.tap_stream_id,
+                                          len(update_buffer),
+                                          self.update_buffer_sizer.length)
+        self.lag.observe_lookup()
+
+        lookup = executor.submit(look_up_update_buffer,
+                                 client,
+                                 update_buffer,
+                                 self.stream_projection,
+                                 self.database_name,
+                                 self.collection_name)
+        self.pending_lookups.append((update_buffer, lookup))
+
+    def write_lookups(self, time_extracted, wait=False, document_id=None):
+        '''
+        Write the documents of the lookups that have completed, in the order the
+        lookups were issued. With wait, wait for every pending lookup, and with
+        document_id, for every lookup up to the last one of that document, so
+        records of later oplog entries for it are not overtaken.
+        '''
+        wait_count = len(self.pending_lookups) if wait else 0
+        if document_id is not None:
+            for index, (update_buffer, _) in enumerate(self.pending_lookups):
+                if document_id in update_buffer:
+                    wait_count = max(wait_count, index + 1)
+
+        # bound the lookups in flight
+        wait_count = max(wait_count, len(self.pending_lookups) - common.MAX_PARALLEL_CURSORS)
+
+        while self.pending_lookups and (wait_count > 0 or self.pending_lookups[0][1].done()):
+            update_buffer, lookup = self.pending_lookups.popleft()
+            wait_count -= 1
+
+            rows, seconds, document_sizes = lookup.result()
+            common.record_update_buffer_lookup(self.tap_stream_id, seconds)
+            self.update_buffer_sizer.observe_lookup(len(update_buffer),
+                                                    len(bson.encode({'_id': next(iter(update_buffer))})),
+                                                    document_sizes,
+                                                    seconds)
+            self.update_buffer_sizer.next_length()
+
+            for buffered_row in rows:
+                write_schema(self.schema, buffered_row, self.stream)
+                record_message = common.row_to_singer_record(self.stream,
+                                                             buffered_row,
+                                                             self.version,
+                                                             time_extracted)
+                singer.write_message(record_message, allow_nan=True)
+                self.checkpoints.observe_record(buffered_row)
+                self.lag.observe_records()
+
+                self.rows_saved += 1
+
+
+def get_document_id(row):
+    if row['op'] == 'u':
+        return row['o2']['_id']
+    return row.get('o', {}).get('_id')
+
+
+def get_transaction_key(row):
+    if 'txnNumber' not in row:
+        return None
+    return bson.encode(row['lsid']), row['txnNumber']
+
+
+class TransactionAssembler():
+    '''
+    Assembles the operations of transactions whose applyOps entries are chained
+    by prevOpTime: the partialTxn entries of a transaction too large for one
+    entry and the prepare entry of a prepared transaction. The operations are
+    returned once the final applyOps or the commitTransaction entry is read, with
+    the ts of that entry, and dropped on abortTransaction.
+
+    The operations of open transactions are kept in memory up to
+    MAX_TRANSACTION_BUFFER_BYTES. Beyond that, a transaction only keeps the ts of
+    its entries, and read_entries reads them again one at a time at commit.
+    '''
+    def __init__(self, namespaces, read_entries):
+        self.namespaces = set(namespaces)
+        self.read_entries = read_entries
+        self.transactions = {}
+        self.buffer_bytes = 0
+
+    def get_earliest_ts(self):
+        '''
+        The ts of the first entry of the open transactions. Bookmarks do not go
+        past it, or the operations before the commit would not be read again.
+        '''
+        return min((transaction['first_ts'] for transaction in self.transactions.values()), default=None)
+
+    def get_operations(self, row):
+        return [op for op in row['o'].get('applyOps', []) if op.get('ns') in self.namespaces]
+
+    def buffer(self, key, row):
+        transaction = self.transactions.setdefault(key, {'first_ts': row['ts'],
+                                                         'entry_ts': [],
+                                                         'operations': [],
+                                                         'bytes': 0})
+        transaction['entry_ts'].append(row['ts'])
+        if transaction['operations'] is None:
+            return
+
+        operations = self.get_operations(row)
+        size = sum(common.get_document_size(op) for op in operations)
+        if self.buffer_bytes + size > MAX_TRANSACTION_BUFFER_BYTES:
+            LOGGER.info('Transaction starting at %s exceeds the transaction buffer, '
+                        'its entries will be read again at commit', transaction['first_ts'])
+            self.buffer_bytes -= transaction['bytes']
+            transaction['operations'] = None
+            transaction['bytes'] = 0
+            return
+
+        transaction['operations'].extend(operations)
+        transaction['bytes'] += size
+        self.buffer_bytes += size
+
+    def release(self, transaction):
+        self.buffer_bytes -= transaction['bytes']
+        if transaction['operations'] is not None:
+            yield from transaction['operations']
+            return
+        for row in self.read_entries(transaction['entry_ts']):
+            yield from self.get_operations(row)
+
+    def process(self, row):
+        '''
+        Yield the operations of row that are committed once row is read, with
+        their ts set to the ts of row.
+        '''
+        if row['ns'] != 'admin.$cmd':
+            yield row
+            return
+
+        key = get_transaction_key(row)
+        command = row['o']
+        if key is not None and (command.get('partialTxn') or command.get('prepare')):
+            self.buffer(key, row)
+            return
+
+        if 'abortTransaction' in command:
+            self.transactions.pop(key, None)
+            return
+
+        operations = []
+        if key in self.transactions:
+            operations = self.release(self.transactions.pop(key))
+        for operation in itertools.chain(operations, self.get_operations(row)):
+            operation['ts'] = row['ts']
+            yield operation
+
+
+def build_oplog_pipeline(oplog_query, projection, namespaces):
+    '''
+    Aggregation equivalent of the oplog query, which also drops the operations of
+    transactions (applyOps entries) on other namespaces on the server, instead of
+    sending whole transactions to be filtered by the tap.
+    '''
+    pipeline = [
+        {'$match': oplog_query},
+        # only the applyOps of commands, a document can have its own applyOps field
+        {'$addFields': {'o.applyOps': {'$cond': [
+            {'$and': [{'$eq': ['$op', 'c']}, {'$isArray': '$o.applyOps'}]},
+            {'$filter': {'input': '$o.applyOps', 'cond': {'$in': ['$$this.ns', namespaces]}}},
+            '$o.applyOps'
+        ]}}}
+    ]
+    if projection:
+        pipeline.append({'$project': projection})
+    return pipeline
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def find_oplog(client, oplog_query, projection, namespaces, session=None, tail=False):
+    if tail:
+        cursor = client.local.oplog.rs.find(oplog_query,
+                                            projection,
+                                            cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+                                            oplog_replay=use_oplog_replay(client),
+                                            session=session,
+                                            no_cursor_timeout=True)
+        return cursor.max_await_time_ms(TAIL_AWAIT_TIME_MS)
+
+    if common.OPLOG_AGGREGATION:
+        # the $natural hint keeps the oplog order, aggregate does not take
+        # oplogReplay or noCursorTimeout
+        return client.local.oplog.rs.aggregate(build_oplog_pipeline(oplog_query, projection, namespaces),
+                                               hint={'$natural': 1},
+                                               session=session)
+
+    # default behavior is a non_tailable cursor but we might want a tailable one
+    # regardless of whether its long lived or not.
+    return client.local.oplog.rs.find(oplog_query,
+                                      projection,
+                                      sort=[('$natural', pymongo.ASCENDING)],
+                                      oplog_replay=use_oplog_replay(client),
+                                      session=session,
+                                      no_cursor_timeout=True)
+
+
+def merge_oplogs(cursor_factories):
+    '''
+    Read the oplogs of the shards in cursor_factories in parallel and yield
+    (index, entry) tuples in ts order. An entry is only yielded once every oplog
+    still being read has returned its next entry, so none of them can return an
+    earlier one. Each oplog is read ahead into its own queue of
+    MERGE_BUFFER_SIZE entries, a reader whose queue is full waits for the
+    merge instead of buffering without bound.
+    '''
+    buffers = [queue.Queue(maxsize=MERGE_BUFFER_SIZE) for _ in cursor_factories]
+    stop = threading.Event()
+    heads = {}
+    reading = set(range(len(cursor_factories)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(cursor_factories)) as executor:
+        for index, cursor_factory in enumerate(cursor_factories):
+            executor.submit(common.drain_cursor, buffers[index], stop, index, cursor_factory, 'oplog')
+        try:
+            while reading or heads:
+                for index in sorted(reading - set(heads)):
+                    _, row = buffers[index].get()
+                    if isinstance(row, Exception):
+                        raise row
+                    if row is common.CURSOR_EXHAUSTED:
+                        reading.discard(index)
+                    else:
+                        heads[index] = row
+
+                if heads:
+                    earliest = min(heads, key=lambda i: heads[i]['ts'])
+                    yield earliest, heads.pop(earliest)
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_oplog_query(oplog_ts, namespaces):
     oplog_query = {
         '$and': [
             {'ts': {'$gte': oplog_ts}},
             {
                 '$or': [
-                    {'ns': '{}.{}'.format(database_name, collection_name)},
-                    {'op': 'c', 'o.applyOps.ns': '{}.{}'.format(database_name, collection_name)}
+                    {'ns': {'$in': namespaces}},
+                    {'op': 'c', 'o.applyOps.ns': {'$in': namespaces}},
+                    # the last entry of a transaction over several entries
+                    # commits the operations of the ones before
+                    {'op': 'c',
+                     'ns': 'admin.$cmd',
+                     'o.partialTxn': {'$exists': False},
+                     'prevOpTime.ts': {'$gt': timestamp.Timestamp(0, 0)}}
                 ]
             }
         ]
     }
+    if common.SHARD_CLIENTS:
+        # the balancer moves documents between shards with fromMigrate entries,
+        # the documents themselves do not change
+        oplog_query['$and'].append({'fromMigrate': {'$ne': True}})
+        # the noop entries a primary writes while idle let the merge of the
+        # shard oplogs go past the last entry read on a shard without writes
+        oplog_query['$and'][1]['$or'].append({'op': 'n'})
+    return oplog_query
 
-    projection = transform_projection(stream_projection)
 
-    oplog_replay = stream_projection is None
+# pylint: disable=too-many-locals, too-many-branches, too-many-statements
+def sync_oplog_streams(client, oplog_streams, state, max_oplog_ts=None, tail=False):
+    '''
+    Read the oplog once from the earliest bookmark of oplog_streams and route each
+    entry to the stream of its namespace. Entries older than a stream's own
+    bookmark were synced by that stream before and are skipped. With tail, keep
+    reading new entries as they are written instead of returning at the end of
+    the oplog. On a sharded cluster, the oplog of every shard is read in parallel
+    from its own bookmarks and the entries are merged in ts order.
+    '''
+    streams_by_namespace = {oplog_stream.namespace: oplog_stream for oplog_stream in oplog_streams}
+    namespaces = sorted(streams_by_namespace)
+    tap_stream_ids = [oplog_stream.tap_stream_id for oplog_stream in oplog_streams]
+    oplog_clients = get_oplog_clients(client)
 
-    LOGGER.info('Querying %s with:\n\tFind Parameters: %s\n\tProjection: %s\n\toplog_replay: %s',
-                tap_stream_id, oplog_query, projection, oplog_replay)
+    for oplog_stream in oplog_streams:
+        oplog_stream.oplog_ts_by_shard = {shard: get_bookmarked_ts(state, oplog_stream.tap_stream_id, shard)
+                                          for shard in oplog_clients}
 
-    update_buffer = set()
-    schema = {"type": "object", "properties": {}}
+        # Write activate version message
+        singer.write_message(singer.ActivateVersionMessage(
+            stream=common.calculate_destination_stream_name(oplog_stream.stream),
+            version=oplog_stream.version
+        ))
 
-    # Get the current time for the purposes of periodically refreshing the session
-    session_refresh_time = time.time()
+    oplog_ts_by_shard = {shard: min(oplog_stream.oplog_ts_by_shard[shard] for oplog_stream in oplog_streams)
+                         for shard in oplog_clients}
+    oplog_queries = {shard: get_oplog_query(oplog_ts, namespaces) for shard, oplog_ts in oplog_ts_by_shard.items()}
 
-    # Create a session so that we can periodically send a simple command to keep it alive
-    with maybe_get_session(client) as session:
-
-        have_session = not isinstance(session, SessionNotAvailable)
-
-        # consider adding oplog_replay, but this would require removing the projection
-        # default behavior is a non_tailable cursor but we might want a tailable one
-        # regardless of whether its long lived or not.
-        with client.local.oplog.rs.find(
-                oplog_query,
-                projection,
-                sort=[('$natural', pymongo.ASCENDING)],
-                oplog_replay=oplog_replay,
-                session=session if have_session else None,
-                no_cursor_timeout=True
-        ) as cursor:
-            # Refresh the session every 10 minutes to keep it alive
-            if have_session and time.time() - session_refresh_time > 600:
-                client.local.command('ping', session=session)
-                session_refresh_time = time.time()
-
-            for row in cursor:
-                # assertions that mongo is respecing the ts query and sort order
-                if row.get('ts') and row.get('ts') < oplog_ts:
-                    raise common.MongoAssertionException("Mongo is not honoring the query param")
-                if row.get('ts') and row.get('ts') < timestamp.Timestamp(stream_state['oplog_ts_time'],
-                                                                        stream_state['oplog_ts_inc']):
-                    raise common.MongoAssertionException(
-                        "Mongo is not honoring the sort ascending param")
-
-                row_namespace = row['ns']
-                current_namespace = f"{database_name}.{collection_name}"
-                if row_namespace == 'admin.$cmd':
-                    # If the namespace is 'admin.$cmd', then the operation on the record was performed as part
-                    # of a transaction and is recorded as a transactional applyOps entry.
-                    for transaction_row in row['o']['applyOps']:
-                        transaction_row['ts'] = row['ts']
-                        rows_saved, update_buffer = process_row(schema, transaction_row, stream, update_buffer,
-                                                                   rows_saved, version, time_extracted, current_namespace)
-                else:
-                    rows_saved, update_buffer = process_row(schema, row, stream, update_buffer,
-                                                               rows_saved, version, time_extracted, current_namespace)
-
-
-                state = update_bookmarks(state,
-                                        tap_stream_id,
-                                        row['ts'])
-
-                # flush buffer if it has filled up
-                if len(update_buffer) >= MAX_UPDATE_BUFFER_LENGTH:
-                    for buffered_row in flush_buffer(client,
-                                                    update_buffer,
-                                                    stream_projection,
-                                                    database_name,
-                                                    collection_name):
-                        write_schema(schema, buffered_row, stream)
-                        record_message = common.row_to_singer_record(stream,
-                                                                    buffered_row,
-                                                                    version,
-                                                                    time_extracted)
-                        singer.write_message(record_message, allow_nan=True)
-
-                        rows_saved += 1
-                    update_buffer = set()
-
-                # write state every UPDATE_BOOKMARK_PERIOD messages
-                if rows_saved % common.UPDATE_BOOKMARK_PERIOD == 0:
-                    # flush buffer before writing state
-                    for buffered_row in flush_buffer(client,
-                                                    update_buffer,
-                                                    stream_projection,
-                                                    database_name,
-                                                    collection_name):
-                        write_schema(schema, buffered_row, stream)
-                        record_message = common.row_to_singer_record(stream,
-                                                                    buffered_row,
-                                                                    version,
-                                                                    time_extracted)
-                        singer.write_message(record_message, allow_nan=True)
-
-                        rows_saved += 1
-                    update_buffer = set()
-
-                    # write state
-                    singer.write_message(singer.StateMessage(value=state))
-
-            # flush buffer if finished with oplog
-            for buffered_row in flush_buffer(client,
-                                            update_buffer,
-                                            stream_projection,
-                                            database_name,
-                                            collection_name):
-                write_schema(schema, buffered_row, stream)
-                record_message = common.row_to_singer_record(stream,
-                                                            buffered_row,
-                                                            version,
-                                                            time_extracted)
+    time_extracted = utils.now()
+    start_time = time.time()
 
-                singer.write_message(record_message, allow_nan=True)
-                rows_saved += 1
+    checkpoints = common.CheckpointScheduler()
+    for oplog_stream in oplog_streams:
+        oplog_stream.checkpoints = checkpoints
+        oplog_stream.lag = common.LagReporter(oplog_stream.tap_stream_id)
+
+    # the streams of a pass share their projection
+    stream_projection = oplog_streams[0].stream_projection
+    projection = transform_projection(stream_projection)
 
+    for shard, oplog_query in oplog_queries.items():
+        shard_name = ' on shard {}'.format(shard) if shard is not None else ''
+        if common.OPLOG_AGGREGATION:
+            LOGGER.info('Querying oplog%s for %s with:\n\tPipeline: %s', shard_name,
+                        ', '.join(tap_stream_ids), build_oplog_pipeline(oplog_query, projection, namespaces))
+        else:
+            LOGGER.info('Querying oplog%s for %s with:\n\tFind Parameters: %s\n\tProjection: %s\n\toplog_replay: %s',
+                        shard_name, ', '.join(tap_stream_ids), oplog_query, projection,
+                        use_oplog_replay(oplog_clients[shard]))
+
+    def read_entries(shard):
+        def read(entry_ts):
+            with oplog_clients[shard].local.oplog.rs.find({'ts': {'$in': entry_ts}},
+                                                          projection,
+                                                          sort=[('$natural', pymongo.ASCENDING)]) as cursor:
+                yield from cursor
+        return read
+
+    assemblers = {shard: TransactionAssembler(namespaces, read_entries(shard)) for shard in oplog_clients}
+
+    def get_resume_ts(ts, shard=None):
+        # bookmarks stay at the first entry of the open transactions, of shard
+        # or of any shard
+        for assembler_shard, assembler in assemblers.items():
+            earliest_ts = assembler.get_earliest_ts()
+            if earliest_ts is not None and shard in (None, assembler_shard):
+                ts = min(ts, earliest_ts)
+        return ts
+
+    # batch sizes of a shared pass are not attributed to any one stream
+    batch_size_key = tap_stream_ids[0] if len(tap_stream_ids) == 1 else 'oplog'
+
+    # Get the current time for the purposes of periodically refreshing the session
+    session_refresh_time = time.time()
 
-    # Compare the current bookmark with the max_oplog_ts and write the max
-    bookmarked_ts = timestamp.Timestamp(state.get('bookmarks', {}).get(tap_stream_id, {}).get('oplog_ts_time'),
-                                        state.get('bookmarks', {}).get(tap_stream_id, {}).get('oplog_ts_inc'))
+    # lookups of the update buffers run on executor while the oplog is read
+    def flush_buffers(wait):
+        for oplog_stream in oplog_streams:
+            oplog_stream.flush(client, executor)
+            oplog_stream.write_lookups(time_extracted, wait=wait)
+
+    def checkpoint():
+        # flush buffers and wait for their lookups before writing state,
+        # every stream has then synced the oplog of each shard up to its last ts
+        nonlocal state
+        flush_buffers(wait=True)
+        for oplog_stream in oplog_streams:
+            for shard, shard_ts in last_ts_by_shard.items():
+                if shard is not None and oplog_stream.oplog_ts_by_shard[shard] <= shard_ts:
+                    state = update_bookmarks(state, oplog_stream.tap_stream_id, get_resume_ts(shard_ts, shard), shard)
+            if oplog_stream.oplog_ts <= last_ts:
+                state = update_bookmarks(state, oplog_stream.tap_stream_id, get_resume_ts(last_ts))
+
+        # write state
+        singer.write_message(singer.StateMessage(value=state))
+
+    def report_lag(synced_ts=None):
+        # the head of the oplog is read once for all streams of the pass, which
+        # have synced it up to synced_ts, or up to the head if it is None. The
+        # query skips other namespaces, so the ts of the last entry read lags
+        # behind the position of the cursor until it runs out of entries.
+        head_ts = get_cluster_latest_ts(client)
+        for oplog_stream in oplog_streams:
+            oplog_stream.lag.report(max(synced_ts or head_ts, oplog_stream.oplog_ts), head_ts)
+
+    def process_oplog_row(shard, row):
+        nonlocal state, last_ts, session_refresh_time
+
+        # Refresh the session every 10 minutes to keep it alive
+        if have_session and time.time() - session_refresh_time > common.SESSION_REFRESH_PERIOD:
+            client.local.command('ping', session=session)
+            session_refresh_time = time.time()
+
+        # assertions that mongo is respecing the ts query and sort order
+        if row.get('ts') and row.get('ts') < oplog_ts_by_shard[shard]:
+            raise common.MongoAssertionException("Mongo is not honoring the query param")
+        if row.get('ts') and row.get('ts') < last_ts_by_shard[shard]:
+            raise common.MongoAssertionException(
+                "Mongo is not honoring the sort ascending param")
+        last_ts_by_shard[shard] = row['ts']
+        last_ts = row['ts']
+        checkpoints.observe_oplog_entry()
+
+        for entry in assemblers[shard].process(row):
+            oplog_stream = streams_by_namespace.get(entry.get('ns'))
+            if oplog_stream is None or entry['ts'] < oplog_stream.oplog_ts_by_shard[shard]:
+                continue
+
+            oplog_stream.write_lookups(time_extracted, document_id=get_document_id(entry))
+            oplog_stream.process_row(entry, time_extracted)
+            state = update_bookmarks(state, oplog_stream.tap_stream_id, get_resume_ts(entry['ts']))
+
+            # flush buffer if it has filled up
+            if oplog_stream.is_update_buffer_full():
+                oplog_stream.flush(client, executor)
+
+        if oplog_streams[0].lag.is_due():
+            report_lag(last_ts)
 
-    actual_max_ts = max(bookmarked_ts, max_oplog_ts)
+    # Create a session so that we can periodically send a simple command to keep it alive
+    # lookups of the update buffers run on executor while the oplog is read
+    with common.maybe_get_session(client) as session, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=common.MAX_PARALLEL_CURSORS) as executor:
+
+        have_session = not isinstance(session, common.SessionNotAvailable)
+
+        last_ts_by_shard = dict(oplog_ts_by_shard)
+        last_ts = min(oplog_ts_by_shard.values())
+        flush_time = time.time()
+
+        if common.SHARD_CLIENTS:
+            shards = list(oplog_clients)
+
+            def cursor_factory(shard):
+                return lambda: find_oplog(oplog_clients[shard], oplog_queries[shard], projection, namespaces)
+
+            for index, row in merge_oplogs([cursor_factory(shard) for shard in shards]):
+                process_oplog_row(shards[index], row)
+                if checkpoints.checkpoint():
+                    checkpoint()
+
+            # flush buffers if finished with oplog
+            flush_buffers(wait=True)
+            report_lag(max(last_ts, max_oplog_ts or last_ts))
+        else:
+            reopen_ts = None
+            reopen_seconds = TAIL_REOPEN_SECONDS
+            # the head of the oplog when the tailable cursor last caught up
+            caught_up_head_ts = None
+            while True:
+                with find_oplog(client,
+                                oplog_queries[None],
+                                projection,
+                                namespaces,
+                                session if have_session else None,
+                                tail) as cursor:
+                    # a tailable cursor stops iterating when no new entry came within
+                    # its await time, and stays alive for the next ones
+                    while cursor.alive:
+                        for row in common.iterate_cursor(cursor, batch_size_key):
+                            process_oplog_row(None, row)
+
+                            if checkpoints.checkpoint():
+                                checkpoint()
+                            elif tail and time.time() - flush_time >= TAIL_FLUSH_SECONDS:
+                                # updates are emitted within seconds while tailing
+                                flush_buffers(wait=False)
+                                flush_time = time.time()
+
+                        if not tail:
+                            break
+
+                        # the oplog is caught up, emit what is buffered. The query skips
+                        # other namespaces, so the ts of the last entry read stays behind
+                        # while the selected collections are quiet. Since the cursor
+                        # caught up again, it has read every entry up to the head of
+                        # the oplog when it last caught up, and streams bookmark that.
+                        if caught_up_head_ts is not None and caught_up_head_ts > last_ts:
+                            last_ts = last_ts_by_shard[None] = caught_up_head_ts
+                        caught_up_head_ts = get_latest_ts(client)
+                        flush_buffers(wait=True)
+                        flush_time = time.time()
+                        if oplog_streams[0].lag.is_due():
+                            report_lag()
+                        if checkpoints.checkpoint():
+                            checkpoint()
+
+                # flush buffers if finished with oplog
+                flush_buffers(wait=True)
+                report_lag(last_ts if tail else max(last_ts, max_oplog_ts or last_ts))
+
+                if not tail:
+                    break
+
+                # the server closes a tailable cursor when, e.g., the oplog rolls over
+                # its position. It can only be reopened after the last entry read
+                # while that entry is still in the oplog, or entries would be missed.
+                if get_earliest_ts(client) > last_ts:
+                    raise common.OplogRolledOverException(
+                        'Oplog rolled over past {} while tailing {}, the next sync of these streams will '
+                        'resync them since their bookmarks have aged out'.format(last_ts, ', '.join(tap_stream_ids)))
+
+                reopen_seconds = TAIL_REOPEN_SECONDS if last_ts != reopen_ts else min(reopen_seconds * 2,
+                                                                                      MAX_TAIL_REOPEN_SECONDS)
+                reopen_ts = last_ts
+                LOGGER.info('Tailable oplog cursor closed, reopening it at %s in %s seconds', last_ts, reopen_seconds)
+                time.sleep(reopen_seconds)
+                oplog_queries[None]['$and'][0] = {'ts': {'$gte': last_ts}}
+
+    for oplog_stream in oplog_streams:
+        # Compare the current bookmark with the max_oplog_ts and write the max
+        bookmarked_ts = get_bookmarked_ts(state, oplog_stream.tap_stream_id)
+        actual_max_ts = get_resume_ts(max(bookmarked_ts, max_oplog_ts) if max_oplog_ts else bookmarked_ts)
+
+        state = update_bookmarks(state,
+                                 oplog_stream.tap_stream_id,
+                                 actual_max_ts)
+
+        # every shard has been read past the max_oplog_ts of the cluster
+        for shard in oplog_clients:
+            if shard is not None:
+                shard_ts = max(last_ts_by_shard[shard], oplog_stream.oplog_ts_by_shard[shard], actual_max_ts)
+                state = update_bookmarks(state, oplog_stream.tap_stream_id, get_resume_ts(shard_ts, shard), shard)
+
+        common.COUNTS[oplog_stream.tap_stream_id] += oplog_stream.rows_saved
+        # the streams of a pass share its time
+        common.TIMES[oplog_stream.tap_stream_id] += time.time()-start_time
+        LOGGER.info('Synced %s records for %s', oplog_stream.rows_saved, oplog_stream.tap_stream_id)
 
-    state = update_bookmarks(state,
-                             tap_stream_id,
-                             actual_max_ts)
     singer.write_message(singer.StateMessage(value=state))
 
-    common.COUNTS[tap_stream_id] += rows_saved
-    common.TIMES[tap_stream_id] += time.time()-start_time
-    LOGGER.info('Synced %s records for %s', rows_saved, tap_stream_id)
+
+def sync_collections(client, streams, state, stream_projections, max_oplog_ts=None, tail=False):
+    '''
+    Sync the LOG_BASED streams with one oplog pass per distinct projection, instead
+    of one pass per stream. A tailing pass never returns, so it needs all streams
+    to share their projection.
+    '''
+    streams_by_projection = {}
+    for stream in streams:
+        stream_projection = stream_projections.get(stream['tap_stream_id'])
+        projection_key = json.dumps(stream_projection, sort_keys=True)
+        streams_by_projection.setdefault(projection_key, []).append(
+            OplogStream(stream, state, stream_projection))
+
+    if tail:
+        if len(streams_by_projection) > 1:
+            raise Exception("Tailing the oplog requires all LOG_BASED streams to have the same projection")
+        sync_oplog_streams(client, next(iter(streams_by_projection.values())), state, tail=True)
+        return
+
+    for oplog_streams in streams_by_projection.values():
+        sync_oplog_streams(client, oplog_streams, state, max_oplog_ts)
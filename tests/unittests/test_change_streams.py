@@ -0,0 +1,117 @@
+import unittest
+from unittest import mock
+from bson import timestamp
+
+import tap_mongodb.sync_strategies.change_streams as change_streams
+
+
+class FakeChangeStream:
+    def __init__(self, changes, post_batch_resume_token):
+        self.changes = list(changes)
+        self.post_batch_resume_token = post_batch_resume_token
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        if not self.changes:
+            self.resume_token = self.post_batch_resume_token
+            return None
+        change = self.changes.pop(0)
+        self.resume_token = change['_id']
+        return change
+
+
+class FakeClient(dict):
+    def __init__(self, databases, latest_ts):
+        super().__init__(databases)
+        self.admin = mock.Mock()
+        self.admin.command.return_value = {'lastWrite': {'opTime': {'ts': latest_ts}}}
+
+
+class FakeCollection:
+    def __init__(self, change_stream):
+        self.change_stream = change_stream
+        self.watch_args = None
+
+    def options(self):
+        return {}
+
+    def watch(self, pipeline, **kwargs):
+        self.watch_args = dict(kwargs, pipeline=pipeline)
+        return self.change_stream
+
+
+def change(token, operation_type, ts, _id):
+    return {'_id': {'_data': token},
+            'operationType': operation_type,
+            'clusterTime': timestamp.Timestamp(ts, 0),
+            'documentKey': {'_id': _id},
+            'fullDocument': {'_id': _id, 'a': ts}}
+
+
+STREAM = {'tap_stream_id': 'db-coll',
+          'stream': 'coll',
+          'table_name': 'coll',
+          'metadata': [{'breadcrumb': [], 'metadata': {'database-name': 'db'}}]}
+
+
+class TestChangeStreams(unittest.TestCase):
+
+    def setUp(self):
+        for summary in (change_streams.common.COUNTS, change_streams.common.TIMES,
+                        change_streams.common.SCHEMA_COUNT, change_streams.common.SCHEMA_TIMES):
+            summary['db-coll'] = 0
+
+    def sync(self, changes, state, max_oplog_ts):
+        collection = FakeCollection(FakeChangeStream(changes, {'_data': 'post-batch'}))
+        client = FakeClient({'db': {'coll': collection}}, timestamp.Timestamp(20, 0))
+        with mock.patch('singer.write_message') as write_message:
+            change_streams.sync_collection(client, STREAM, state, None, max_oplog_ts)
+        records = [call[0][0].record for call in write_message.call_args_list
+                   if isinstance(call[0][0], change_streams.singer.RecordMessage)]
+        return collection, records
+
+    def test_starts_at_bookmarked_ts_and_stores_resume_token(self):
+        state = {'bookmarks': {'db-coll': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+        collection, records = self.sync([change('a', 'insert', 2, 1), change('b', 'delete', 3, 2)],
+                                        state, timestamp.Timestamp(10, 0))
+
+        self.assertEqual(timestamp.Timestamp(1, 0), collection.watch_args['start_at_operation_time'])
+        self.assertEqual([{'_id': 1, 'a': 2}, {'_id': 2, '_sdc_deleted_at': '1970-01-01T00:00:03.000000Z'}],
+                         [dict(r) for r in records])
+        self.assertEqual({'_data': 'post-batch'}, state['bookmarks']['db-coll']['resume_token'])
+        self.assertEqual(10, state['bookmarks']['db-coll']['oplog_ts_time'])
+        self.assertEqual(10, change_streams.common.OPLOG_LAG['db-coll']['lag_seconds'])
+
+    def test_resumes_after_token_and_stops_past_max_ts(self):
+        state = {'bookmarks': {'db-coll': {'resume_token': {'_data': 'a'}, 'oplog_ts_time': 2,
+                                           'oplog_ts_inc': 0, 'version': 1}}}
+        collection, records = self.sync([change('b', 'update', 3, 1), change('c', 'update', 4, 1),
+                                         change('d', 'update', 5, 1)],
+                                        state, timestamp.Timestamp(3, 0))
+
+        self.assertEqual({'_data': 'a'}, collection.watch_args['resume_after'])
+        self.assertEqual(2, len(records))
+        self.assertEqual({'_data': 'c'}, state['bookmarks']['db-coll']['resume_token'])
+        self.assertEqual(4, state['bookmarks']['db-coll']['oplog_ts_time'])
+
+
+class TestTransformProjection(unittest.TestCase):
+
+    def test_no_projection(self):
+        self.assertEqual([{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}],
+                         change_streams.build_pipeline(None))
+
+    def test_whitelist_keeps_change_fields(self):
+        self.assertEqual({'_id': 1, 'operationType': 1, 'clusterTime': 1, 'documentKey': 1,
+                          'fullDocument._id': 1, 'fullDocument.a': 1},
+                         change_streams.transform_projection({'a': 1}))
+
+    def test_blacklist(self):
+        self.assertEqual({'fullDocument.a': 0}, change_streams.transform_projection({'a': 0, '_id': 1}))
@@ -434,3 +434,106 @@ class TestRowToSchemaMessage(unittest.TestCase):
         self.assertTrue(changed)
         self.assertFalse(changed_2)
         self.assertEqual(expected, schema)
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def test_batch_size_doubles_at_most(self):
+        sizer = common.BatchSizer()
+        sizer.observe_document_size(100)
+        sizer.observe_batch(101, 0.001)
+
+        self.assertEqual(202, sizer.next_batch_size())
+        self.assertEqual(404, sizer.next_batch_size())
+
+    def test_batch_size_respects_byte_budget(self):
+        sizer = common.BatchSizer()
+        sizer.observe_document_size(common.TARGET_BATCH_BYTES / 10)
+        sizer.observe_batch(101, 0.001)
+
+        self.assertEqual(10, sizer.next_batch_size())
+
+    def test_batch_size_respects_latency_budget(self):
+        sizer = common.BatchSizer()
+        sizer.observe_document_size(10)
+        sizer.observe_batch(100, 1000 * common.TARGET_BATCH_SECONDS)
+
+        self.assertEqual(common.MIN_BATCH_SIZE, sizer.next_batch_size())
+
+
+class TestRawBSONDocument(unittest.TestCase):
+
+    def test_raw_document_matches_decoded_document(self):
+        row = {
+            "_id": bson.objectid.ObjectId(),
+            "a_date": bson.timestamp.Timestamp(1565897157, 1),
+            "a_decimal": bson.Decimal128(decimal.Decimal('1.34')),
+            "an_object": {"a_nested_list": [1, {"a_float": 1.5}]}
+        }
+        raw_row = bson.raw_bson.RawBSONDocument(bson.encode(row))
+        stream = {'tap_stream_id': 'db-collection', 'stream': 'collection', 'metadata': []}
+
+        schema = {"type": "object", "properties": {}}
+        raw_schema = {"type": "object", "properties": {}}
+        self.assertTrue(common.row_to_schema(schema, row))
+        self.assertTrue(common.row_to_schema(raw_schema, raw_row))
+        self.assertEqual(schema, raw_schema)
+
+        record = common.row_to_singer_record(stream, row, 1, None)
+        raw_record = common.row_to_singer_record(stream, raw_row, 1, None)
+        self.assertEqual(record.record, raw_record.record)
+
+
+class TestCheckpointScheduler(unittest.TestCase):
+
+    def test_checkpoints_every_period_of_records(self):
+        checkpoints = common.CheckpointScheduler()
+        due = []
+        for _ in range(2 * common.UPDATE_BOOKMARK_PERIOD):
+            checkpoints.observe_record()
+            due.append(checkpoints.checkpoint())
+        self.assertEqual(2, sum(due))
+
+    def test_sparse_streams_checkpoint_on_oplog_entries_and_time(self):
+        checkpoints = common.CheckpointScheduler()
+        for _ in range(common.CHECKPOINT_OPLOG_ENTRIES - 1):
+            checkpoints.observe_oplog_entry()
+            self.assertFalse(checkpoints.checkpoint())
+        checkpoints.observe_oplog_entry()
+        self.assertTrue(checkpoints.checkpoint())
+
+        checkpoints.checkpoint_time -= common.CHECKPOINT_SECONDS
+        self.assertTrue(checkpoints.checkpoint())
+        self.assertFalse(checkpoints.checkpoint())
+
+    def test_checkpoints_on_bytes(self):
+        checkpoints = common.CheckpointScheduler()
+        checkpoints.observe_record({'a': 'x' * (common.CHECKPOINT_BYTES // common.DOCUMENT_SIZE_SAMPLE_PERIOD)})
+        self.assertTrue(checkpoints.checkpoint())
+
+
+class TestLagReporter(unittest.TestCase):
+
+    def test_reports_lag_rates_and_catch_up_time(self):
+        lag = common.LagReporter('db-coll')
+        for _ in range(10):
+            lag.observe_oplog_entry()
+        lag.observe_records(4)
+        lag.observe_lookup()
+        lag.report_time -= 10
+
+        report = lag.report(bson.timestamp.Timestamp(100, 0), bson.timestamp.Timestamp(160, 0))
+        self.assertEqual(60, report['lag_seconds'])
+        self.assertAlmostEqual(1, report['oplog_entries_per_second'], places=2)
+        self.assertAlmostEqual(0.4, report['records_per_second'], places=2)
+        self.assertEqual(1, report['update_buffer_lookups'])
+        # no earlier lag to estimate from
+        self.assertIsNone(report['catch_up_seconds'])
+        self.assertEqual(report, common.OPLOG_LAG['db-coll'])
+
+        # the lag went down 20 seconds in 10 seconds
+        lag.report_time -= 10
+        report = lag.report(bson.timestamp.Timestamp(150, 0), bson.timestamp.Timestamp(190, 0))
+        self.assertEqual(40, report['lag_seconds'])
+        self.assertAlmostEqual(20, report['catch_up_seconds'], places=2)
+        self.assertEqual(0, report['update_buffer_lookups'])
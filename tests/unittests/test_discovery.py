@@ -0,0 +1,126 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+import tap_mongodb
+
+
+class FakeCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def options(self):
+        raise AssertionError('options are read from listCollections')
+
+    def estimated_document_count(self):
+        self.database.counts += 1
+        return 10
+
+    def index_information(self):
+        self.database.index_reads += 1
+        return self.database.indexes
+
+
+class FakeDatabase(dict):
+    def __init__(self, name, collection_infos):
+        super().__init__()
+        self.name = name
+        self.collection_infos = collection_infos
+        self.list_collections_calls = 0
+        self.counts = 0
+        self.index_reads = 0
+        self.indexes = {'_id_': {'key': [('_id', 1)]}}
+
+    def __missing__(self, collection_name):
+        return FakeCollection(self, collection_name)
+
+    def list_collections(self):
+        self.list_collections_calls += 1
+        return self.collection_infos
+
+
+class FakeClient(dict):
+    def __init__(self, databases, version=(5, 0)):
+        super().__init__(databases)
+        self.version = version
+        self.admin = mock.Mock()
+        self.admin.aggregate = self.list_catalog
+
+    def server_info(self):
+        return {'versionArray': list(self.version)}
+
+    def list_catalog(self, pipeline):
+        return [{'db': database.name, 'name': info['name'],
+                 'md': {'indexes': [{'spec': dict(index_info, name=name, key=dict(index_info['key']))}
+                                    for name, index_info in database.indexes.items()]}}
+                for database in self.values() for info in database.collection_infos]
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def discover(self, client, config=None):
+        with mock.patch.object(tap_mongodb, 'get_databases', return_value=list(client)), \
+             mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            tap_mongodb.do_discover(client, config or {})
+        return json.loads(stdout.getvalue())['streams']
+
+    def test_streams_are_ordered_and_views_skipped(self):
+        client = FakeClient({'db2': FakeDatabase('db2', [{'name': 'b', 'options': {}},
+                                                         {'name': 'a', 'options': {}}]),
+                             'db1': FakeDatabase('db1', [{'name': 'v', 'options': {'viewOn': 'c'}},
+                                                         {'name': 'system.views', 'options': {}},
+                                                         {'name': 'c', 'options': {}}])})
+
+        streams = self.discover(client)
+
+        self.assertEqual(['db1-c', 'db2-a', 'db2-b'], [stream['tap_stream_id'] for stream in streams])
+        self.assertEqual([1, 1], [db.list_collections_calls for db in client.values()])
+
+    def test_unchanged_collections_are_read_from_the_cache(self):
+        for version in ((5, 0), (6, 0)):
+            with self.subTest(version=version):
+                database = FakeDatabase('db', [{'name': 'a', 'options': {}, 'info': {'uuid': uuid.uuid4()}},
+                                               {'name': 'b', 'options': {}, 'info': {'uuid': uuid.uuid4()}}])
+                client = FakeClient({'db': database}, version)
+
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    config = {'discovery_cache': os.path.join(cache_dir, 'discovery.json')}
+                    streams = self.discover(client, config)
+
+                    # cached streams are reused without querying their collections
+                    database.counts = database.index_reads = 0
+                    self.assertEqual(streams, self.discover(client, config))
+                    self.assertEqual((0, 0), (database.counts, database.index_reads))
+
+                    # altered options change the stream of that collection only
+                    database.collection_infos[1]['options'] = {'validator': {'x': 1}}
+                    self.discover(client, config)
+                    self.assertEqual(1, database.counts)
+
+    def test_new_indexes_are_discovered_from_the_catalog(self):
+        database = FakeDatabase('db', [{'name': 'a', 'options': {}, 'info': {'uuid': uuid.uuid4()}}])
+        client = FakeClient({'db': database}, (6, 0))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            config = {'discovery_cache': os.path.join(cache_dir, 'discovery.json')}
+            self.discover(client, config)
+
+            # a new index changes the valid replication keys
+            database.indexes = dict(database.indexes, updated_at_1={'key': [('updated_at', 1)]})
+            streams = self.discover(client, config)
+            self.assertEqual(2, database.counts)
+            self.assertIn('updated_at', streams[0]['metadata'][0]['metadata']['valid-replication-keys'])
+
+    def test_indexes_are_read_from_the_collections_when_list_catalog_fails(self):
+        database = FakeDatabase('db', [{'name': 'a', 'options': {}}])
+        client = FakeClient({'db': database}, (7, 0))
+        client.admin.aggregate = mock.Mock(side_effect=tap_mongodb.pymongo.errors.OperationFailure('Unauthorized'))
+
+        self.discover(client)
+
+        self.assertEqual(1, database.index_reads)
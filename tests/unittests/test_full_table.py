@@ -0,0 +1,165 @@
+import unittest
+from unittest import mock
+import bson
+import pymongo
+
+import tap_mongodb
+import tap_mongodb.sync_strategies.common as common
+import tap_mongodb.sync_strategies.full_table as full_table
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda row: row[field]))
+
+    def skip(self, count):
+        return FakeCursor(self[count:])
+
+    def limit(self, count):
+        return FakeCursor(self[:count])
+
+
+class FakeCollection:
+    def __init__(self, ids):
+        self.ids = ids
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return [{'_id': i} for i in sorted(self.ids)]
+
+    def count_documents(self, find_filter):
+        return len(self.ids)
+
+    def find(self, find_filter, projection):
+        return FakeCursor({'_id': i} for i in self.ids)
+
+
+class TestPartitions(unittest.TestCase):
+
+    def test_build_partitions_covers_id_range(self):
+        collection = FakeCollection(range(1, 101))
+        partitions = full_table.build_partitions(collection, 100, 4)
+
+        self.assertEqual(4, len(partitions))
+        self.assertIsNone(partitions[0]['min'])
+        self.assertEqual('100', partitions[-1]['max'])
+        self.assertTrue(partitions[-1]['max_inclusive'])
+        for lower, upper in zip(partitions, partitions[1:]):
+            self.assertEqual(lower['max'], upper['min'])
+            self.assertFalse(lower['max_inclusive'])
+
+        # the server samples documents with a random cursor before filtering them
+        self.assertEqual({'$sample': {'size': 4 * common.SAMPLES_PER_BOUNDARY}},
+                         collection.pipelines[0][0])
+
+    def test_boundaries_are_read_from_the_index_when_few_samples_match(self):
+        collection = FakeCollection(range(1, 101))
+        collection.aggregate = lambda pipeline: [{'_id': 50}]
+
+        self.assertEqual([26, 51, 76], common.sample_boundaries(collection, '_id', {}, 4, 'int'))
+
+    def test_build_partitions_ignores_other_id_types(self):
+        collection = FakeCollection([])
+        collection.aggregate = lambda pipeline: [{'_id': 'a'}, {'_id': 'b'}]
+        partitions = full_table.build_partitions(collection, 100, 4)
+
+        self.assertEqual(1, len(partitions))
+        self.assertEqual({'$lte': 100}, full_table.get_partition_filter(partitions[0]))
+
+    def test_partition_filter_resumes_from_last_id_fetched(self):
+        object_id = bson.objectid.ObjectId()
+        partition = {'min': str(bson.objectid.ObjectId('000000000000000000000000')),
+                     'max': str(object_id),
+                     'max_inclusive': False,
+                     'type': 'ObjectId',
+                     'last_id_fetched': '5d7a3a8b0000000000000000',
+                     'complete': False}
+
+        self.assertEqual({'$lt': object_id,
+                          '$gte': bson.objectid.ObjectId('5d7a3a8b0000000000000000')},
+                         full_table.get_partition_filter(partition))
+
+
+class TestReadCursorsInParallel(unittest.TestCase):
+
+    def test_rows_keep_per_cursor_order(self):
+        class Cursor(list):
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                pass
+
+        factories = [lambda: Cursor(range(0, 50)), lambda: Cursor(range(50, 100))]
+        seen = {0: [], 1: []}
+        exhausted = []
+        for index, row in common.read_cursors_in_parallel(factories, max_workers=2):
+            if row is common.CURSOR_EXHAUSTED:
+                exhausted.append(index)
+            else:
+                seen[index].append(row)
+
+        self.assertEqual(list(range(0, 50)), seen[0])
+        self.assertEqual(list(range(50, 100)), seen[1])
+        self.assertEqual([0, 1], sorted(exhausted))
+
+    def test_cursor_errors_are_raised(self):
+        def failing_factory():
+            raise RuntimeError('boom')
+
+        with self.assertRaises(RuntimeError):
+            list(common.read_cursors_in_parallel([failing_factory]))
+
+
+class TestSnapshotErrors(unittest.TestCase):
+
+    def test_snapshot_errors_fall_back(self):
+        snapshot_ts = bson.timestamp.Timestamp(1565897157, 1)
+        too_old = pymongo.errors.OperationFailure('SnapshotTooOld', code=239)
+        duplicate = pymongo.errors.OperationFailure('E11000', code=11000)
+        invalid_options = pymongo.errors.OperationFailure('InvalidOptions', code=72)
+
+        with self.assertLogs(full_table.LOGGER, 'WARNING') as logs:
+            self.assertTrue(full_table.is_snapshot_error(too_old, snapshot_ts, 'db-coll'))
+        self.assertIn('db-coll', logs.output[0])
+        self.assertFalse(full_table.is_snapshot_error(too_old, None, 'db-coll'))
+        self.assertFalse(full_table.is_snapshot_error(duplicate, snapshot_ts, 'db-coll'))
+        # a misconfiguration is not hidden by the fallback
+        self.assertFalse(full_table.is_snapshot_error(invalid_options, snapshot_ts, 'db-coll'))
+
+
+class TestNaturalOrder(unittest.TestCase):
+
+    @mock.patch('tap_mongodb.sync_strategies.common.find_command')
+    def test_resumes_after_record_id(self, find_command):
+        full_table.find_natural_order('collection', {'name': 1}, bson.int64.Int64(42))
+
+        find_command.assert_called_once_with('collection',
+                                             filter={},
+                                             hint={'$natural': 1},
+                                             showRecordId=True,
+                                             projection={'name': 1},
+                                             **{'$_requestResumeToken': True,
+                                                '$_resumeAfter': {'$recordId': 42}})
+
+    def test_scan_order_is_validated(self):
+        stream = {'metadata': [{'breadcrumb': [],
+                                'metadata': {'tap-mongodb.full-table-scan': 'random'}}]}
+        with self.assertRaises(Exception):
+            full_table.get_scan_order(stream)
+
+
+class TestChangeProbe(unittest.TestCase):
+
+    def test_dbhash_is_the_default(self):
+        collection = mock.Mock()
+        collection.name = 'coll'
+        collection.database.command.return_value = {'collections': {'coll': 'abc'}}
+
+        self.assertEqual('abc', full_table.get_change_fingerprint(collection, None))
+        collection.database.command.assert_called_once_with('dbHash', collections=['coll'])
+
+    def test_probe_is_validated(self):
+        self.assertEqual('collstats', tap_mongodb.get_change_probe({'change_probe': 'collstats'}))
+        with self.assertRaises(Exception):
+            tap_mongodb.get_change_probe({'change_probe': 'colstats'})
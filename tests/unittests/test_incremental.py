@@ -0,0 +1,281 @@
+import contextlib
+import datetime
+import unittest
+from unittest import mock
+import bson
+import pytz
+
+import tap_mongodb
+import tap_mongodb.sync_strategies.incremental as incremental
+
+
+class FakeCollection:
+    def __init__(self, rows, indexes=None):
+        self.rows = rows
+        self.indexes = indexes or {'_id_': {'key': [('_id', 1)]},
+                                   'updated_1': {'key': [('updated', 1)]}}
+
+    def index_information(self):
+        return self.indexes
+
+    def distinct(self, field):
+        return sorted({r[field] for r in self.rows if field in r})
+
+    def find_one(self, find_filter, sort, projection, hint):
+        field = sort[0][0]
+        rows = [r for r in self.rows if field in r]
+        if not rows:
+            return None
+        return {field: max(r[field] for r in rows)}
+
+    def count_documents(self, find_filter, hint=None):
+        return len([r for r in self.rows if r.get('updated') == find_filter['updated']])
+
+
+class TestChangeFingerprint(unittest.TestCase):
+
+    def test_fingerprint_changes_on_new_max_or_tie(self):
+        rows = [{'_id': 1, 'updated': 1}, {'_id': 2, 'updated': 2}]
+        collection = FakeCollection(rows)
+        fingerprint = incremental.get_change_fingerprint(collection, 'updated')
+        self.assertEqual('int:2:1', fingerprint)
+
+        rows.append({'_id': 3, 'updated': 2})
+        self.assertNotEqual(fingerprint, incremental.get_change_fingerprint(collection, 'updated'))
+
+        rows.append({'_id': 4, 'updated': 3})
+        self.assertEqual('int:3:1', incremental.get_change_fingerprint(collection, 'updated'))
+
+    def test_fingerprint_of_empty_collection(self):
+        self.assertEqual('empty', incremental.get_change_fingerprint(FakeCollection([]), 'updated'))
+
+    def test_unsupported_types_are_not_probed(self):
+        collection = FakeCollection([{'_id': 1, 'updated': bson.decimal128.Decimal128('1.5')}])
+        self.assertIsNone(incremental.get_change_fingerprint(collection, 'updated'))
+
+    def test_windowed_runs_are_not_skipped_before_reaching_the_max(self):
+        client = {'db': {'coll': FakeCollection([{'_id': 1, 'updated': 1}, {'_id': 2, 'updated': 100}])}}
+        stream = {'tap_stream_id': 'db-coll', 'stream': 'coll',
+                  'metadata': [{'breadcrumb': [], 'metadata': {'database-name': 'db',
+                                                               'replication-method': 'INCREMENTAL',
+                                                               'replication-key': 'updated'}}]}
+        state = {'bookmarks': {'db-coll': {'replication_key_value': '10', 'replication_key_type': 'int'}}}
+        fingerprint = tap_mongodb.get_change_fingerprint(client, stream, state)
+        self.assertTrue(tap_mongodb.has_pending_window(client, stream, state))
+
+        # the fingerprint does not depend on the bookmark, once the bookmark
+        # reaches the max the stream is skipped from the next run on
+        state['bookmarks']['db-coll']['replication_key_value'] = '100'
+        self.assertEqual(fingerprint, tap_mongodb.get_change_fingerprint(client, stream, state))
+        self.assertFalse(tap_mongodb.has_pending_window(client, stream, state))
+
+
+class TestIndexPlan(unittest.TestCase):
+
+    def test_index_led_by_replication_key(self):
+        collection = FakeCollection([], {'_id_': {'key': [('_id', 1)]},
+                                         'updated_1_tenant_1': {'key': [('updated', 1), ('tenant', 1)]}})
+        self.assertEqual({'hint': 'updated_1_tenant_1', 'filter': {}, 'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated'))
+
+    def test_compound_index_suffix_matches_every_prefix_value(self):
+        collection = FakeCollection([{'tenant': 'a'}, {'tenant': 'b'}],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'tenant_1_updated_1': {'key': [('tenant', 1), ('updated', 1)]}})
+        self.assertEqual({'hint': 'tenant_1_updated_1',
+                          'filter': {'tenant': {'$in': ['a', 'b', None]}},
+                          'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated', prefix_scans=True))
+
+    def test_partial_and_special_indexes_are_ignored(self):
+        collection = FakeCollection([], {'updated_1': {'key': [('updated', 1)],
+                                                       'partialFilterExpression': {'a': 1}},
+                                         'updated_text': {'key': [('updated', 'text')]}})
+        self.assertEqual({'hint': None, 'filter': {}, 'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated'))
+
+    def test_index_followed_by_id_is_preferred(self):
+        collection = FakeCollection([{'tenant': 'a'}],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'updated_1': {'key': [('updated', 1)]},
+                                     'updated_1__id_1': {'key': [('updated', 1), ('_id', 1)]},
+                                     'tenant_1_updated_1__id_1': {'key': [('tenant', 1), ('updated', 1), ('_id', 1)]}})
+        self.assertEqual({'hint': 'updated_1__id_1', 'filter': {}, 'sort': [('updated', 1), ('_id', 1)]},
+                         incremental.get_index_plan(collection, 'updated', prefix_scans=True))
+
+        collection = FakeCollection([{'tenant': 'a'}],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'tenant_1_updated_1': {'key': [('tenant', 1), ('updated', 1)]},
+                                     'tenant_1_updated_1__id_1': {'key': [('tenant', 1), ('updated', 1), ('_id', 1)]}})
+        self.assertEqual({'hint': 'tenant_1_updated_1__id_1',
+                          'filter': {'tenant': {'$in': ['a', None]}},
+                          'sort': [('updated', 1), ('_id', 1)]},
+                         incremental.get_index_plan(collection, 'updated', prefix_scans=True))
+
+    def test_index_led_by_the_key_is_preferred_over_prefix_scans(self):
+        collection = FakeCollection([{'tenant': 'a'}],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'updated_1': {'key': [('updated', 1)]},
+                                     'tenant_1_updated_1__id_1': {'key': [('tenant', 1), ('updated', 1), ('_id', 1)]}})
+        self.assertEqual({'hint': 'updated_1', 'filter': {}, 'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated', prefix_scans=True))
+
+    def test_prefix_with_too_many_values_falls_back_to_sorting(self):
+        collection = FakeCollection([{'tenant': i} for i in range(incremental.MAX_SORT_MERGE_SCANS)],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'tenant_1_updated_1': {'key': [('tenant', 1), ('updated', 1)]}})
+        self.assertEqual({'hint': None, 'filter': {}, 'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated', prefix_scans=True))
+
+    def test_prefix_scans_are_left_out_by_default(self):
+        collection = FakeCollection([{'tenant': 'a'}],
+                                    {'_id_': {'key': [('_id', 1)]},
+                                     'tenant_1_updated_1': {'key': [('tenant', 1), ('updated', 1)]}})
+        collection.distinct = None
+        self.assertEqual({'hint': None, 'filter': {}, 'sort': [('updated', 1)]},
+                         incremental.get_index_plan(collection, 'updated'))
+
+
+class TestPrefixScans(unittest.TestCase):
+
+    class RecordingCollection(FakeCollection):
+        def __init__(self, rows, indexes):
+            super().__init__(rows, indexes)
+            self.calls = []
+            self.find_filters = []
+
+        def distinct(self, field):
+            self.calls.append('distinct')
+            return super().distinct(field)
+
+        def find_one(self, find_filter, sort, projection, hint):
+            self.calls.append('find_one')
+            return super().find_one(find_filter, sort, projection, hint)
+
+        def find(self, find_filter, projection, sort, hint):
+            self.find_filters.append(find_filter)
+            return contextlib.nullcontext([])
+
+    def sync(self, state):
+        collection = self.RecordingCollection([{'_id': 1, 'tenant': 'a', 'updated': 5}],
+                                              {'_id_': {'key': [('_id', 1)]},
+                                               'tenant_1_updated_1': {'key': [('tenant', 1), ('updated', 1)]}})
+        stream = {'tap_stream_id': 'db-coll', 'stream': 'coll',
+                  'metadata': [{'breadcrumb': [], 'metadata': {'database-name': 'db',
+                                                               'replication-key': 'updated'}}]}
+        incremental.common.COUNTS['db-coll'] = 0
+        incremental.common.TIMES['db-coll'] = 0
+        with mock.patch('singer.write_message'):
+            incremental.sync_collection({'db': {'coll': collection}}, stream, state, None)
+        return collection
+
+    def test_prefix_values_are_read_after_the_upper_bound(self):
+        collection = self.sync({'bookmarks': {'db-coll': {'replication_key_value': '1',
+                                                          'replication_key_type': 'int'}}})
+        self.assertEqual(['distinct', 'find_one', 'distinct'], collection.calls)
+        self.assertEqual({'$in': ['a', None]}, collection.find_filters[0]['tenant'])
+
+    def test_runs_without_upper_bound_do_not_merge_prefix_scans(self):
+        collection = self.sync({})
+        self.assertEqual([{}], collection.find_filters)
+        self.assertEqual([], collection.calls)
+
+
+class TestReplicationKeyFilter(unittest.TestCase):
+
+    def test_without_last_id(self):
+        self.assertEqual({'updated': {'$gte': 5}},
+                         incremental.get_replication_key_filter('updated', {'$gte': 5}))
+
+    def test_resumes_after_last_id(self):
+        self.assertEqual({'$or': [{'updated': {'$lt': 10, '$gt': 5}},
+                                  {'updated': 5, '_id': {'$gt': 'x'}}]},
+                         incremental.get_replication_key_filter('updated', {'$gte': 5, '$lt': 10}, 'x'))
+
+    def test_bookmark_records_last_id(self):
+        state = {}
+        incremental.update_bookmark({'_id': bson.ObjectId('0' * 24), 'updated': 5},
+                                    state, 'db-coll', 'updated', tiebreak=True)
+        self.assertEqual({'replication_key_value': '5',
+                          'replication_key_type': 'int',
+                          'replication_key_last_id': '0' * 24,
+                          'replication_key_last_id_type': 'ObjectId'},
+                         state['bookmarks']['db-coll'])
+
+        incremental.update_bookmark({'_id': 1, 'updated': 6}, state, 'db-coll', 'updated')
+        self.assertEqual({'replication_key_value': '6', 'replication_key_type': 'int'},
+                         state['bookmarks']['db-coll'])
+
+
+class TestUpperBound(unittest.TestCase):
+
+    def get_upper_bound(self, rows, lower, window_size=None):
+        return incremental.get_upper_bound(FakeCollection(rows), 'updated', lower, None, window_size)
+
+    def test_upper_bound_is_max_at_start(self):
+        self.assertEqual(9, self.get_upper_bound([{'updated': 3}, {'updated': 9}], 3))
+        self.assertEqual(9, self.get_upper_bound([{'updated': 3}, {'updated': 9}], 3, 100))
+        self.assertIsNone(self.get_upper_bound([{'updated': 3}], 3))
+        self.assertIsNone(self.get_upper_bound([{'updated': 'a'}], 3))
+
+    def test_window_limits_upper_bound(self):
+        self.assertEqual(5, self.get_upper_bound([{'updated': 3}, {'updated': 9}], 3, 2))
+
+        lower = datetime.datetime(2024, 1, 1, tzinfo=pytz.UTC)
+        rows = [{'updated': datetime.datetime(2024, 2, 1)}]
+        self.assertEqual(datetime.datetime(2024, 1, 2),
+                         self.get_upper_bound(rows, lower, 24 * 60 * 60))
+
+    def test_window_size_from_metadata(self):
+        def get_window_size(window_size):
+            return incremental.get_window_size({'tap-mongodb.incremental-window': window_size})
+
+        self.assertEqual(3600, get_window_size('3600'))
+        self.assertIsInstance(get_window_size('3600'), int)
+        self.assertEqual(0.5, get_window_size('0.5'))
+        self.assertEqual(60, get_window_size(60))
+        self.assertIsNone(get_window_size(0))
+        self.assertIsNone(incremental.get_window_size({}))
+        for window_size in ('an hour', 'nan', [60]):
+            with self.assertRaises(Exception):
+                get_window_size(window_size)
+
+    def test_windows_below_one_unit_end_past_lower(self):
+        self.assertEqual(11, incremental.get_window_upper_bound(bson.int64.Int64(10), 0.5))
+        self.assertIsInstance(incremental.get_window_upper_bound(bson.int64.Int64(10), 0.5), bson.int64.Int64)
+        self.assertEqual(10.5, incremental.get_window_upper_bound(10.0, 0.5))
+        self.assertEqual(bson.timestamp.Timestamp(11, 0),
+                         incremental.get_window_upper_bound(bson.timestamp.Timestamp(10, 3), 0.5))
+        lower = bson.ObjectId.from_datetime(datetime.datetime(2024, 1, 1))
+        self.assertTrue(incremental.is_after(incremental.get_window_upper_bound(lower, 0.5), lower))
+
+    def test_window_ignored_for_unsupported_types(self):
+        self.assertEqual('z', self.get_upper_bound([{'updated': 'b'}, {'updated': 'z'}], 'a', 2))
+
+
+class TestChunks(unittest.TestCase):
+
+    def test_build_chunks_covers_range(self):
+        collection = FakeCollection([])
+        collection.aggregate = lambda pipeline: [{'updated': v} for v in range(10, 51)]
+        chunks = incremental.build_chunks(collection, 'updated', 10, 50, 4)
+
+        self.assertEqual(4, len(chunks))
+        self.assertEqual(10, chunks[0]['$gte'])
+        self.assertEqual(50, chunks[-1]['$lte'])
+        for lower, upper in zip(chunks, chunks[1:]):
+            self.assertEqual(lower['$lt'], upper['$gte'])
+
+    def test_bookmark_only_advances_over_completed_prefix(self):
+        chunks = [{'$gte': 0, '$lt': 10}, {'$gte': 10, '$lt': 20}, {'$gte': 20, '$lte': 30}]
+        start = (0, 'a')
+
+        def bookmark(positions, completed):
+            return incremental.get_chunk_bookmark(chunks, positions, completed, start)
+
+        self.assertEqual(start, bookmark([None, (15, 'b'), None], [False, False, True]))
+        self.assertEqual((5, 'c'), bookmark([(5, 'c'), None, (25, 'd')], [False, True, False]))
+        self.assertEqual((10, None), bookmark([(5, 'c'), None, (25, 'd')], [True, False, False]))
+        self.assertEqual((25, 'd'), bookmark([(5, 'c'), (15, 'b'), (25, 'd')], [True, True, False]))
+        self.assertEqual((28, 'e'), bookmark([(5, 'c'), (15, 'b'), (28, 'e')], [True] * 3))
+        self.assertEqual(start, bookmark([None] * 3, [True] * 3))
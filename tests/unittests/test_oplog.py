@@ -0,0 +1,444 @@
+import contextlib
+import time
+import unittest
+from unittest import mock
+from bson import timestamp
+from pymongo.errors import ConfigurationError
+
+import tap_mongodb
+import tap_mongodb.sync_strategies.oplog as oplog
+
+
+class FakeCursor(list):
+    alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeCollection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+        self.find_kwargs = []
+
+    def aggregate(self, pipeline, **kwargs):
+        self.queries.append(pipeline[0]['$match'])
+        self.find_kwargs.append(dict(kwargs, pipeline=pipeline))
+        return FakeCursor(self.rows)
+
+    def find_one(self, **kwargs):
+        return {'ts': timestamp.Timestamp(10, 0)}
+
+    def find(self, query, projection=None, **kwargs):
+        self.queries.append(query)
+        self.find_kwargs.append(kwargs)
+        return FakeCursor(self.rows)
+
+
+class FakeClient(dict):
+    def __init__(self, oplog_rows, collections):
+        super().__init__(collections)
+        self.local = mock.Mock()
+        self.local.oplog.rs = FakeCollection(oplog_rows)
+
+    def start_session(self):
+        raise ConfigurationError('no sessions')
+
+    def server_info(self):
+        return {'versionArray': [4, 2, 0, 0]}
+
+
+def make_stream(collection_name):
+    return {'tap_stream_id': 'db-' + collection_name,
+            'stream': collection_name,
+            'table_name': collection_name,
+            'metadata': [{'breadcrumb': [], 'metadata': {'database-name': 'db'}}]}
+
+
+def entry(ts, ns, op, _id):
+    row = {'ts': timestamp.Timestamp(ts, 0), 'ns': ns, 'op': op, 'o': {'_id': _id}}
+    if op == 'u':
+        row['o2'] = {'_id': _id}
+    return row
+
+
+class TestMultiplexedOplog(unittest.TestCase):
+
+    def setUp(self):
+        for stream_id in ('db-a', 'db-b'):
+            for summary in (oplog.common.COUNTS, oplog.common.TIMES,
+                            oplog.common.SCHEMA_COUNT, oplog.common.SCHEMA_TIMES):
+                summary[stream_id] = 0
+
+    def test_single_pass_routes_entries_from_each_bookmark(self):
+        oplog_rows = [entry(1, 'db.a', 'i', 1),
+                      entry(2, 'db.b', 'i', 2),
+                      entry(3, 'db.a', 'u', 1),
+                      {'ts': timestamp.Timestamp(4, 0), 'ns': 'admin.$cmd', 'op': 'c',
+                       'o': {'applyOps': [entry(0, 'db.b', 'i', 3), entry(0, 'db.c', 'i', 4)]}}]
+        client = FakeClient(oplog_rows, {'db': {'a': FakeCollection([{'_id': 1, 'x': 1}])}})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1},
+                               'db-b': {'oplog_ts_time': 3, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message') as write_message:
+            oplog.sync_collections(client, [make_stream('a'), make_stream('b')], state,
+                                   {}, timestamp.Timestamp(10, 0))
+
+        query = client.local.oplog.rs.queries[0]
+        self.assertEqual(timestamp.Timestamp(1, 0), query['$and'][0]['ts']['$gte'])
+        self.assertEqual({'$in': ['db.a', 'db.b']}, query['$and'][1]['$or'][0]['ns'])
+
+        records = [(call[0][0].stream, call[0][0].record) for call in write_message.call_args_list
+                   if isinstance(call[0][0], oplog.singer.RecordMessage)]
+        # the insert into b before its bookmark is skipped
+        self.assertEqual([('a', {'_id': 1}), ('b', {'_id': 3}), ('a', {'_id': 1, 'x': 1})], records)
+
+        self.assertEqual(10, state['bookmarks']['db-a']['oplog_ts_time'])
+        self.assertEqual(10, state['bookmarks']['db-b']['oplog_ts_time'])
+        self.assertEqual(2, oplog.common.COUNTS['db-a'])
+        self.assertEqual(1, oplog.common.COUNTS['db-b'])
+
+    def test_lookups_are_written_before_later_entries_of_their_document(self):
+        oplog_rows = [entry(1, 'db.a', 'u', 1), entry(2, 'db.a', 'd', 1), entry(3, 'db.a', 'i', 2)]
+        client = FakeClient(oplog_rows, {'db': {'a': FakeCollection([{'_id': 1, 'x': 1}])}})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message') as write_message, \
+             mock.patch.object(oplog, 'INITIAL_UPDATE_BUFFER_LENGTH', 1):
+            oplog.sync_collections(client, [make_stream('a')], state, {}, timestamp.Timestamp(10, 0))
+
+        records = [call[0][0].record for call in write_message.call_args_list
+                   if isinstance(call[0][0], oplog.singer.RecordMessage)]
+        self.assertEqual([{'_id': 1, 'x': 1}, {'_id': 1}, {'_id': 2}],
+                         [{k: v for k, v in record.items() if k != '_sdc_deleted_at'} for record in records])
+
+    def test_streams_with_different_projections_do_not_share_a_pass(self):
+        client = FakeClient([], {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0},
+                               'db-b': {'oplog_ts_time': 1, 'oplog_ts_inc': 0}}}
+
+        with mock.patch('singer.write_message'):
+            oplog.sync_collections(client, [make_stream('a'), make_stream('b')], state,
+                                   {'db-a': {'x': 1}}, timestamp.Timestamp(10, 0))
+
+        self.assertEqual(2, len(client.local.oplog.rs.queries))
+        # the projected pass seeks to its start like the unprojected one
+        self.assertEqual([True, True], [kwargs['oplog_replay'] for kwargs in client.local.oplog.rs.find_kwargs])
+
+    def test_server_version_is_read_once_per_client(self):
+        client = FakeClient([], {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0},
+                               'db-b': {'oplog_ts_time': 1, 'oplog_ts_inc': 0}}}
+
+        with mock.patch('singer.write_message'), \
+             mock.patch.object(FakeClient, 'server_info', return_value={'versionArray': [4, 2, 0, 0]}) as server_info:
+            oplog.sync_collections(client, [make_stream('a'), make_stream('b')], state,
+                                   {'db-a': {'x': 1}}, timestamp.Timestamp(10, 0))
+
+        self.assertEqual(1, server_info.call_count)
+
+
+    def test_aggregation_filters_transactions_on_the_server(self):
+        client = FakeClient([entry(1, 'db.a', 'i', 1)], {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message'), mock.patch.object(oplog.common, 'OPLOG_AGGREGATION', True):
+            oplog.sync_collections(client, [make_stream('a')], state, {}, timestamp.Timestamp(10, 0))
+
+        kwargs = client.local.oplog.rs.find_kwargs[0]
+        self.assertEqual({'$natural': 1}, kwargs['hint'])
+        condition, filtered, unchanged = kwargs['pipeline'][1]['$addFields']['o.applyOps']['$cond']
+        self.assertEqual({'$filter': {'input': '$o.applyOps', 'cond': {'$in': ['$$this.ns', ['db.a']]}}}, filtered)
+        # an applyOps field of an inserted or updated document is kept as is
+        self.assertIn({'$eq': ['$op', 'c']}, condition['$and'])
+        self.assertEqual('$o.applyOps', unchanged)
+        self.assertEqual(1, oplog.common.COUNTS['db-a'])
+
+
+    def test_tailing_flushes_and_checkpoints_when_caught_up(self):
+        class StopTailing(Exception):
+            pass
+
+        class FakeTailableCursor(FakeCursor):
+            # returns its rows, then an empty batch, then dies
+            def __iter__(self):
+                rows = list(list.__iter__(self))
+                self.clear()
+                if not rows:
+                    self.alive = False
+                return iter(rows)
+
+        cursors = [FakeTailableCursor([entry(1, 'db.a', 'u', 1)])]
+
+        def find_oplog(client, oplog_query, *args):
+            if not cursors:
+                raise StopTailing()
+            return cursors.pop()
+
+        client = FakeClient([], {'db': {'a': FakeCollection([{'_id': 1, 'x': 1}])}})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message') as write_message, \
+             mock.patch.object(oplog, 'find_oplog', find_oplog), \
+             mock.patch.object(oplog, 'get_earliest_ts', return_value=timestamp.Timestamp(1, 0)), \
+             mock.patch.object(oplog.time, 'sleep') as sleep, \
+             mock.patch.object(oplog.common, 'CHECKPOINT_SECONDS', 0):
+            with self.assertRaises(StopTailing):
+                oplog.sync_collections(client, [make_stream('a')], state, {}, tail=True)
+
+        messages = [call[0][0] for call in write_message.call_args_list]
+        records = [message.record for message in messages if isinstance(message, oplog.singer.RecordMessage)]
+        self.assertEqual([{'_id': 1, 'x': 1}], records)
+        self.assertIsInstance(messages[-1], oplog.singer.StateMessage)
+        sleep.assert_called_once_with(oplog.TAIL_REOPEN_SECONDS)
+
+    def test_tailing_fails_when_the_oplog_rolled_over_the_cursor(self):
+        closed_cursor = FakeCursor([entry(1, 'db.a', 'i', 1)])
+        closed_cursor.alive = False
+        client = FakeClient([], {'db': {'a': FakeCollection([{'_id': 1}])}})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message'), \
+             mock.patch.object(oplog, 'find_oplog', lambda *args: closed_cursor), \
+             mock.patch.object(oplog, 'get_earliest_ts', return_value=timestamp.Timestamp(5, 0)):
+            with self.assertRaises(oplog.common.OplogRolledOverException):
+                oplog.sync_collections(client, [make_stream('a')], state, {}, tail=True)
+
+    def test_tailing_bookmarks_quiet_streams_at_the_head_of_the_oplog(self):
+        class StopTailing(Exception):
+            pass
+
+        class QuietCursor(FakeCursor):
+            # no entry for the stream comes in two waits, then the server closes it
+            waits = 0
+
+            def __iter__(self):
+                self.waits += 1
+                self.alive = self.waits < 2
+                return iter([])
+
+        cursors = [QuietCursor()]
+
+        def find_oplog(client, oplog_query, *args):
+            if not cursors:
+                raise StopTailing()
+            return cursors.pop()
+
+        client = FakeClient([], {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message'), \
+             mock.patch.object(oplog, 'find_oplog', find_oplog), \
+             mock.patch.object(oplog, 'get_earliest_ts', return_value=timestamp.Timestamp(5, 0)), \
+             mock.patch.object(oplog.time, 'sleep'), \
+             mock.patch.object(oplog.common, 'CHECKPOINT_SECONDS', 0):
+            # the oplog rolled over the last entry of the stream, not the cursor
+            with self.assertRaises(StopTailing):
+                oplog.sync_collections(client, [make_stream('a')], state, {}, tail=True)
+
+        # the head of the oplog of the fake client
+        self.assertEqual(10, state['bookmarks']['db-a']['oplog_ts_time'])
+
+    def test_shard_oplogs_are_merged_by_ts_with_their_own_bookmarks(self):
+        shard_clients = {'shard1': FakeClient([entry(1, 'db.a', 'i', 1), entry(4, 'db.a', 'i', 4)], {}),
+                         'shard2': FakeClient([entry(2, 'db.a', 'i', 2), entry(3, 'db.b', 'i', 3),
+                                               {'ts': timestamp.Timestamp(4, 1), 'ns': '', 'op': 'n',
+                                                'o': {'msg': 'periodic noop'}}], {})}
+        client = FakeClient([], {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1,
+                                        'shards': {'shard2': {'oplog_ts_time': 2, 'oplog_ts_inc': 0}}},
+                               'db-b': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1,
+                                        'shards': {'shard2': {'oplog_ts_time': 3, 'oplog_ts_inc': 0}}}}}
+
+        with mock.patch('singer.write_message') as write_message, \
+             mock.patch.object(oplog.common, 'SHARD_CLIENTS', shard_clients):
+            oplog.sync_collections(client, [make_stream('a'), make_stream('b')], state,
+                                   {}, timestamp.Timestamp(5, 0))
+
+        records = [(call[0][0].stream, call[0][0].record) for call in write_message.call_args_list
+                   if isinstance(call[0][0], oplog.singer.RecordMessage)]
+        self.assertEqual([('a', {'_id': 1}), ('a', {'_id': 2}), ('b', {'_id': 3}), ('a', {'_id': 4})], records)
+
+        # each shard is queried from its own bookmark, without migrations
+        self.assertEqual(timestamp.Timestamp(2, 0),
+                         shard_clients['shard2'].local.oplog.rs.queries[0]['$and'][0]['ts']['$gte'])
+        self.assertEqual({'fromMigrate': {'$ne': True}}, shard_clients['shard1'].local.oplog.rs.queries[0]['$and'][2])
+        self.assertIn({'op': 'n'}, shard_clients['shard1'].local.oplog.rs.queries[0]['$and'][1]['$or'])
+        self.assertEqual({'shard1': {'oplog_ts_time': 5, 'oplog_ts_inc': 0},
+                          'shard2': {'oplog_ts_time': 5, 'oplog_ts_inc': 0}},
+                         state['bookmarks']['db-a']['shards'])
+
+    def test_merge_reads_ahead_a_bounded_number_of_entries(self):
+        read = {0: 0, 1: 0}
+
+        def cursor_factory(index, times):
+            def rows():
+                for time in times:
+                    read[index] += 1
+                    yield {'ts': timestamp.Timestamp(time, 0)}
+            return lambda: contextlib.nullcontext(rows())
+
+        factories = [cursor_factory(0, range(0, 100, 2)), cursor_factory(1, range(1, 100, 2))]
+        with mock.patch.object(oplog, 'MERGE_BUFFER_SIZE', 2):
+            merged = oplog.merge_oplogs(factories)
+            self.assertEqual((0, 0), (lambda i, row: (i, row['ts'].time))(*next(merged)))
+            time.sleep(0.2)
+            # the head of each oplog, its queue and the entry its reader waits to put
+            self.assertLessEqual(max(read.values()), 4)
+
+            self.assertEqual(list(range(1, 100)), [row['ts'].time for _, row in merged])
+
+    def test_bookmarks_stay_at_open_transactions(self):
+        lsid = {'id': 1}
+        oplog_rows = [entry(1, 'db.a', 'i', 1),
+                      {'ts': timestamp.Timestamp(2, 0), 'ns': 'admin.$cmd', 'op': 'c', 'lsid': lsid, 'txnNumber': 1,
+                       'o': {'applyOps': [entry(0, 'db.a', 'i', 2)], 'partialTxn': True}},
+                      entry(3, 'db.a', 'i', 3)]
+        client = FakeClient(oplog_rows, {})
+        state = {'bookmarks': {'db-a': {'oplog_ts_time': 1, 'oplog_ts_inc': 0, 'version': 1}}}
+
+        with mock.patch('singer.write_message') as write_message:
+            oplog.sync_collections(client, [make_stream('a')], state, {}, timestamp.Timestamp(10, 0))
+
+        records = [call[0][0].record for call in write_message.call_args_list
+                   if isinstance(call[0][0], oplog.singer.RecordMessage)]
+        self.assertEqual([{'_id': 1}, {'_id': 3}], records)
+        self.assertEqual(2, state['bookmarks']['db-a']['oplog_ts_time'])
+
+
+def transaction_entry(ts, operations, txn_number=1, **command):
+    return {'ts': timestamp.Timestamp(ts, 0), 'ns': 'admin.$cmd', 'op': 'c',
+            'lsid': {'id': 1}, 'txnNumber': txn_number, 'o': dict(command, applyOps=operations)}
+
+
+class TestTransactionAssembler(unittest.TestCase):
+
+    def process(self, assembler, rows):
+        return [(op['ts'].time, op['o']['_id']) for row in rows for op in assembler.process(row)]
+
+    def test_operations_are_released_by_the_last_entry(self):
+        assembler = oplog.TransactionAssembler(['db.a'], None)
+        rows = [transaction_entry(1, [entry(0, 'db.a', 'i', 1), entry(0, 'db.b', 'i', 2)], partialTxn=True),
+                transaction_entry(2, [entry(0, 'db.a', 'i', 3)], partialTxn=True)]
+        self.assertEqual([], self.process(assembler, rows))
+        self.assertEqual(timestamp.Timestamp(1, 0), assembler.get_earliest_ts())
+
+        self.assertEqual([(3, 1), (3, 3), (3, 4)],
+                         self.process(assembler, [transaction_entry(3, [entry(0, 'db.a', 'i', 4)], count=3)]))
+        self.assertIsNone(assembler.get_earliest_ts())
+
+    def test_prepared_transactions_wait_for_their_commit(self):
+        assembler = oplog.TransactionAssembler(['db.a'], None)
+        rows = [transaction_entry(1, [entry(0, 'db.a', 'i', 1)], prepare=True),
+                transaction_entry(2, [entry(0, 'db.a', 'i', 2)], txn_number=2, prepare=True),
+                {'ts': timestamp.Timestamp(3, 0), 'ns': 'admin.$cmd', 'op': 'c', 'lsid': {'id': 1}, 'txnNumber': 1,
+                 'o': {'abortTransaction': 1}},
+                {'ts': timestamp.Timestamp(4, 0), 'ns': 'admin.$cmd', 'op': 'c', 'lsid': {'id': 1}, 'txnNumber': 2,
+                 'o': {'commitTransaction': 1}}]
+        self.assertEqual([(4, 2)], self.process(assembler, rows))
+
+    def test_large_transactions_are_read_again_at_commit(self):
+        rows = [transaction_entry(1, [entry(0, 'db.a', 'i', 1)], partialTxn=True),
+                transaction_entry(2, [entry(0, 'db.a', 'i', 2)], partialTxn=True)]
+        read_entries = mock.Mock(return_value=rows)
+        assembler = oplog.TransactionAssembler(['db.a'], read_entries)
+
+        with mock.patch.object(oplog, 'MAX_TRANSACTION_BUFFER_BYTES', 1):
+            self.assertEqual([(3, 1), (3, 2)],
+                             self.process(assembler, rows + [transaction_entry(3, [], count=2)]))
+        read_entries.assert_called_once_with([timestamp.Timestamp(1, 0), timestamp.Timestamp(2, 0)])
+        self.assertEqual(0, assembler.buffer_bytes)
+
+
+class TestUpdateDeltas(unittest.TestCase):
+
+    def delta(self, update):
+        return oplog.get_update_delta({'op': 'u', 'o': update, 'o2': {'_id': 1}})
+
+    def test_set_and_unset(self):
+        self.assertEqual({'_id': 1, 'a': 2, 'b': None},
+                         self.delta({'$v': 1, '$set': {'a': 2}, '$unset': {'b': True}}))
+
+    def test_diff(self):
+        self.assertEqual({'_id': 1, 'a': 2, 'c': 3, 'b': None},
+                         self.delta({'$v': 2, 'diff': {'u': {'a': 2}, 'i': {'c': 3}, 'd': {'b': False}}}))
+
+    def test_replacement(self):
+        self.assertEqual({'_id': 1, 'a': 2}, self.delta({'_id': 1, 'a': 2}))
+
+    def test_nested_changes_are_looked_up(self):
+        self.assertIsNone(self.delta({'$v': 2, 'diff': {'sa': {'u': {'b': 1}}}}))
+        self.assertIsNone(self.delta({'$set': {'a.b': 1}}))
+        self.assertIsNone(self.delta({'$inc': {'a': 1}}))
+
+    def test_deltas_skip_the_lookup(self):
+        update_buffer = set()
+        with mock.patch('singer.write_message') as write_message:
+            rows_saved, update_buffer = oplog.process_row(
+                {'type': 'object', 'properties': {}},
+                {'op': 'u', 'ns': 'db.a', 'o': {'$v': 2, 'diff': {'u': {'a': 2}}}, 'o2': {'_id': 1}},
+                make_stream('a'), update_buffer, 0, 1, None, 'db.a', apply_update_deltas=True)
+
+        self.assertEqual(1, rows_saved)
+        self.assertEqual(set(), update_buffer)
+        self.assertEqual({'_id': 1, 'a': 2}, write_message.call_args[0][0].record)
+
+
+class TestUpdateBufferSizer(unittest.TestCase):
+
+    def test_grows_at_most_twofold(self):
+        sizer = oplog.UpdateBufferSizer()
+        sizer.observe_lookup(500, 20, [100], 0.01)
+        self.assertEqual(1000, sizer.next_length())
+
+    def test_large_documents_shrink_the_buffer(self):
+        sizer = oplog.UpdateBufferSizer()
+        sizer.observe_lookup(500, 20, [10 * 1024 * 1024], 0.01)
+        self.assertEqual(oplog.MIN_UPDATE_BUFFER_LENGTH, sizer.next_length())
+
+    def test_slow_lookups_shrink_the_buffer(self):
+        sizer = oplog.UpdateBufferSizer()
+        sizer.observe_lookup(500, 20, [100], 5)
+        self.assertEqual(100, sizer.next_length())
+
+
+class TestAgeOutForecast(unittest.TestCase):
+
+    def make_client(self):
+        client = mock.Mock()
+        client.local.oplog.rs.find_one.side_effect = \
+            lambda sort: {'ts': timestamp.Timestamp(1000 if sort[0][1] == 1 else 4600, 0)}
+        # a quarter full after an hour
+        client.local.command.return_value = {'size': 1000, 'maxSize': 4000}
+        return client
+
+    def test_projects_when_bookmarks_age_out(self):
+        window = oplog.get_oplog_window(self.make_client())
+        self.assertEqual(3600, window['window_seconds'])
+        self.assertEqual(4 * 3600, window['capacity_seconds'])
+        # the first entry is dropped 4 hours after it was written
+        self.assertEqual(1000 + 4 * 3600 - 4600,
+                         oplog.get_seconds_until_aged_out(window, timestamp.Timestamp(1000, 0)))
+
+    def test_streams_about_to_age_out_sync_first(self):
+        def stream(name, method):
+            return {'tap_stream_id': name, 'stream': name,
+                    'metadata': [{'breadcrumb': [], 'metadata': {'selected': True, 'replication-method': method}}]}
+
+        streams = [stream('new', 'LOG_BASED'), stream('full', 'FULL_TABLE'),
+                   stream('safe', 'LOG_BASED'), stream('late', 'LOG_BASED'), stream('later', 'LOG_BASED')]
+        state = {'currently_syncing': 'full',
+                 'bookmarks': {'full': {'version': 1},
+                               'safe': {'oplog_ts_time': 4000, 'oplog_ts_inc': 0},
+                               'late': {'oplog_ts_time': 1000, 'oplog_ts_inc': 0},
+                               'later': {'oplog_ts_time': 2000, 'oplog_ts_inc': 0}}}
+
+        with mock.patch.object(oplog.common, 'OPLOG_AGE_OUT_WARNING_SECONDS', 12000):
+            forecast = tap_mongodb.get_age_out_forecast(self.make_client(), streams, state)
+            ordered = tap_mongodb.get_streams_to_sync(streams, state, forecast)
+
+        self.assertEqual(['late', 'later', 'full', 'new', 'safe'], [s['tap_stream_id'] for s in ordered])